@@ -59,6 +59,7 @@
 # brevity, we do not define classes for simple type assignments like
 # KerberosString and TicketFlags.
 
+from pyasn1.error import PyAsn1Error
 from pyasn1.type import base
 from pyasn1.type.char import GeneralString
 from pyasn1.type.univ import BitString, Integer, OctetString
@@ -86,6 +87,72 @@ def _ofield(name, tagnum, asn1type):
             explicitTag=Tag(tagClassContext, tagFormatSimple, tagnum)))
 
 
+class _deferred(object):
+    # A componentType class attribute which is not built until the
+    # type is first instantiated, to keep import time down.  On first
+    # access, the value returned by fn replaces this descriptor in the
+    # class which defined it.
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __get__(self, instance, owner):
+        value = self.fn()
+        # pyasn1 types may be old-style classes, without __mro__.
+        classes = [owner]
+        while classes:
+            cls = classes.pop(0)
+            if cls.__dict__.get('componentType') is self:
+                cls.componentType = value
+                break
+            classes.extend(cls.__bases__)
+        return value
+
+
+class FrozenValueError(PyAsn1Error):
+    pass
+
+
+# Frozen values carry this typeId, which selects an encoder that
+# splices in their cached contents.
+_frozenTypeId = 'pyk5-frozen'
+_frozenCodec = []
+
+
+def _frozen_codec():
+    # Install the frozen value encoder in the pyasn1 codecs, and return
+    # the DER encode function and a plain sequence encoder.  This is
+    # done on first use to avoid importing the codecs along with this
+    # module.
+    if not _frozenCodec:
+        from pyasn1.codec.ber import encoder as ber_encoder
+        from pyasn1.codec.cer import encoder as cer_encoder
+        from pyasn1.codec.der import encoder as der_encoder
+
+        class FrozenSequenceEncoder(ber_encoder.SequenceEncoder):
+            def encodeValue(self, encodeFun, value, defMode, maxChunkSize):
+                if defMode:
+                    return value._frozen, 1
+                return ber_encoder.SequenceEncoder.encodeValue(
+                    self, encodeFun, value, defMode, maxChunkSize)
+
+        enc = FrozenSequenceEncoder()
+        ber_encoder.typeMap[_frozenTypeId] = enc
+        cer_encoder.typeMap[_frozenTypeId] = enc
+        _frozenCodec.extend((der_encoder.encode,
+                             ber_encoder.SequenceEncoder()))
+    return _frozenCodec
+
+
+def _freeze_children(value):
+    # Freeze the _K5Sequence values within value, looking through
+    # SequenceOf values.
+    for v in value._componentValues:
+        if isinstance(v, _K5Sequence):
+            v.freeze()
+        elif isinstance(v, SequenceOf):
+            _freeze_children(v)
+
+
 class _K5Sequence(Sequence):
     # pyasn1 sequence types do not normally allow nested objects to be
     # built from the bottom up; you get a type error when you try to
@@ -105,7 +172,50 @@ class _K5Sequence(Sequence):
     # containing sequence as they should.  Treat interior objects as
     # immutable once they are assigned to a containing sequence, at
     # least until you are done using the containing sequence.
+    #
+    # A value which will be embedded unchanged in many messages (such
+    # as a Ticket) can be frozen with freeze().  A frozen value keeps
+    # the DER encoding of its contents, which is spliced into the
+    # encodings of enclosing values instead of being recomputed.
+    # Assigning to a component of a frozen value raises
+    # FrozenValueError.  Nested _K5Sequence values are frozen along
+    # with it, but other nested constructed values (such as the
+    # name-string list of a PrincipalName) must not be modified.
+    _frozen = None
+
+    def freeze(self, contents=None):
+        # contents, if given, is the DER encoding of the value's
+        # contents (without the SEQUENCE tag and length), for callers
+        # which have already produced it by other means.
+        if self._frozen is None:
+            encode, seqencoder = _frozen_codec()
+            _freeze_children(self)
+            if contents is None:
+                contents = seqencoder.encodeValue(encode, self, True, 0)[0]
+            self._frozen = contents
+            self.typeId = _frozenTypeId
+        return self
+
+    def isFrozen(self):
+        return self._frozen is not None
+
+    def clone(self, tagSet=None, subtypeSpec=None, sizeSpec=None,
+              cloneValueFlag=None):
+        if self._frozen is None or not cloneValueFlag:
+            return Sequence.clone(self, tagSet, subtypeSpec, sizeSpec,
+                                  cloneValueFlag)
+        # A frozen value cannot change, so its clones can share its
+        # components and encoding.
+        r = Sequence.clone(self, tagSet, subtypeSpec, sizeSpec)
+        r._componentValues = self._componentValues
+        r._componentValuesSet = self._componentValuesSet
+        r._frozen = self._frozen
+        r.typeId = self.typeId
+        return r
+
     def setComponentByPosition(self, idx, value=None, *rest, **kw):
+        if self._frozen is not None:
+            raise FrozenValueError('Cannot modify a frozen value')
         if isinstance(value, base.Asn1Item):
             ftags = self._componentType.getTypeByPosition(idx).getTagSet()
             vtags = value.getTagSet()
@@ -122,63 +232,63 @@ class _K5Sequence(Sequence):
 
 
 class PrincipalName(_K5Sequence):
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('name-type', 0, Integer()),
-        _mfield('name-string', 1, SequenceOf(componentType=GeneralString())))
+        _mfield('name-string', 1, SequenceOf(componentType=GeneralString()))))
 
 
 class HostAddress(_K5Sequence):
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('addr-type', 0, Integer()),
-        _mfield('address', 1, OctetString()))
+        _mfield('address', 1, OctetString())))
 
 
 class HostAddresses(SequenceOf):
-    componentType = HostAddress()
+    componentType = _deferred(HostAddress)
 
 
 class AuthorizationData(SequenceOf):
-    componentType = Sequence(componentType=NamedTypes(
+    componentType = _deferred(lambda: Sequence(componentType=NamedTypes(
             _mfield('ad-type', 0, Integer()),
-            _mfield('ad-data', 1, GeneralizedTime())))
+            _mfield('ad-data', 1, GeneralizedTime()))))
 
 
 class PAData(_K5Sequence):
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('padata-type', 1, Integer()),
-        _mfield('padata-value', 2, OctetString()))
+        _mfield('padata-value', 2, OctetString())))
 
 
 class EncryptedData(_K5Sequence):
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('etype', 0, Integer()),
         _ofield('kvno', 1, Integer()),
-        _mfield('cipher', 2, OctetString()))
+        _mfield('cipher', 2, OctetString())))
 
 
 class EncryptionKey(_K5Sequence):
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('keytype', 0, Integer()),
-        _mfield('keyvalue', 1, OctetString()))
+        _mfield('keyvalue', 1, OctetString())))
 
 
 class Checksum(_K5Sequence):
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('cksumtype', 0, Integer()),
-        _mfield('checksum', 1, OctetString()))
+        _mfield('checksum', 1, OctetString())))
 
 
 class Ticket(_K5Sequence):
     tagSet = _apptag(1)
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('tkt-vno', 0, Integer()),
         _mfield('realm', 1, GeneralString()),
         _mfield('sname', 2, PrincipalName()),
-        _mfield('enc-part', 3, EncryptedData()))
+        _mfield('enc-part', 3, EncryptedData())))
 
 
 class KDCReqBody(_K5Sequence):
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('kdc-options', 0, BitString()),
         _ofield('cname', 1, PrincipalName()),
         _mfield('realm', 2, GeneralString()),
@@ -190,15 +300,15 @@ class KDCReqBody(_K5Sequence):
         _mfield('etype', 8, SequenceOf(componentType=Integer())),
         _ofield('addresses', 9, HostAddresses()),
         _ofield('enc-authorization-data', 10, EncryptedData()),
-        _ofield('additional-tickets', 11, SequenceOf(componentType=Ticket())))
+        _ofield('additional-tickets', 11, SequenceOf(componentType=Ticket()))))
 
 
 class KDCReq(_K5Sequence):
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('pvno', 1, Integer()),
         _mfield('msg-type', 2, Integer()),
         _ofield('padata', 3, SequenceOf(componentType=PAData())),
-        _mfield('req-body', 4, KDCReqBody()))
+        _mfield('req-body', 4, KDCReqBody())))
 
 
 class ASReq(KDCReq):
@@ -210,14 +320,14 @@ class TGSReq(KDCReq):
 
 
 class KDCRep(_K5Sequence):
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('pvno', 0, Integer()),
         _mfield('msg-type', 1, Integer()),
         _ofield('padata', 2, SequenceOf(componentType=PAData())),
         _mfield('crealm', 3, GeneralString()),
         _mfield('cname', 4, PrincipalName()),
         _mfield('ticket', 5, Ticket()),
-        _mfield('enc-part', 6, EncryptedData()))
+        _mfield('enc-part', 6, EncryptedData())))
 
 
 class ASRep(KDCRep):
@@ -229,13 +339,13 @@ class TGSRep(KDCRep):
 
 
 class LastReq(SequenceOf):
-    componentType = Sequence(componentType=NamedTypes(
+    componentType = _deferred(lambda: Sequence(componentType=NamedTypes(
             _mfield('lr-type', 0, Integer()),
-            _mfield('lr-value', 1, GeneralizedTime())))
+            _mfield('lr-value', 1, GeneralizedTime()))))
 
 
 class EncKDCRepPart(_K5Sequence):
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('key', 0, EncryptionKey()),
         _mfield('last-req', 1, LastReq()),
         _mfield('nonce', 2, Integer()),
@@ -247,7 +357,7 @@ class EncKDCRepPart(_K5Sequence):
         _ofield('renew-till', 8, GeneralizedTime()),
         _mfield('srealm', 9, GeneralString()),
         _mfield('sname', 10, PrincipalName()),
-        _ofield('caddr', 11, HostAddresses()))
+        _ofield('caddr', 11, HostAddresses())))
 
 
 class EncASRepPart(EncKDCRepPart):
@@ -260,7 +370,7 @@ class EncTGSRepPart(EncKDCRepPart):
 
 class Authenticator(_K5Sequence):
     tagSet = _apptag(2)
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('authenticator-vno', 0, Integer()),
         _mfield('crealm', 1, GeneralString()),
         _mfield('cname', 2, PrincipalName()),
@@ -269,22 +379,22 @@ class Authenticator(_K5Sequence):
         _mfield('ctime', 5, GeneralizedTime()),
         _ofield('subkey', 6, EncryptionKey()),
         _ofield('seq-number', 7, Integer()),
-        _ofield('authorization-data', 8, AuthorizationData()))
+        _ofield('authorization-data', 8, AuthorizationData())))
 
 
 class APReq(_K5Sequence):
     tagSet = _apptag(14)
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('pvno', 0, Integer()),
         _mfield('msg-type', 1, Integer()),
         _mfield('ap-options', 2, BitString()),
         _mfield('ticket', 3, Ticket()),
-        _mfield('authenticator', 4, EncryptedData()))
+        _mfield('authenticator', 4, EncryptedData())))
 
 
 class KrbError(_K5Sequence):
     tagSet = _apptag(30)
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('pvno', 0, Integer()),
         _mfield('msg-type', 1, Integer()),
         _ofield('ctime', 2, GeneralizedTime()),
@@ -297,38 +407,38 @@ class KrbError(_K5Sequence):
         _mfield('realm', 9, GeneralString()),
         _mfield('sname', 10, PrincipalName()),
         _ofield('e-text', 11, GeneralString()),
-        _ofield('e-data', 12, OctetString()))
+        _ofield('e-data', 12, OctetString())))
 
 
 class MethodData(SequenceOf):
-    componentType = PAData()
+    componentType = _deferred(PAData)
 
 
 class PAEncTSEnc(_K5Sequence):
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('patimestamp', 0, GeneralizedTime()),
-        _ofield('pausec', 1, Integer()))
+        _ofield('pausec', 1, Integer())))
 
 
 class ETypeInfoEntry(_K5Sequence):
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('etype', 0, Integer()),
-        _ofield('salt', 1, OctetString()))
+        _ofield('salt', 1, OctetString())))
 
 
 class ETypeInfo(SequenceOf):
-    componentType = ETypeInfoEntry()
+    componentType = _deferred(ETypeInfoEntry)
 
 
 class ETypeInfo2Entry(_K5Sequence):
-    componentType = NamedTypes(
+    componentType = _deferred(lambda: NamedTypes(
         _mfield('etype', 0, Integer()),
         _ofield('salt', 1, GeneralString()),
-        _ofield('a2kparams', 2, OctetString()))
+        _ofield('a2kparams', 2, OctetString())))
 
 
 class ETypeInfo2(SequenceOf):
-    componentType = ETypeInfo2Entry()
+    componentType = _deferred(ETypeInfo2Entry)
 
 
 class NameType(object):
@@ -337,3 +447,81 @@ class NameType(object):
     SRV_INST = 2
     SRV_HOST = 3
     ENTERPRISE = 10
+
+
+if __name__ == '__main__':
+    from pyasn1.codec.der import decoder, encoder
+
+    def ticket():
+        t = Ticket()
+        t['tkt-vno'] = 5
+        t['realm'] = 'KRBTEST.COM'
+        t['sname'] = None
+        t['sname']['name-type'] = NameType.SRV_INST
+        t['sname']['name-string'] = None
+        t['sname']['name-string'][0] = 'krbtgt'
+        t['sname']['name-string'][1] = 'KRBTEST.COM'
+        t['enc-part'] = None
+        t['enc-part']['etype'] = 18
+        t['enc-part']['kvno'] = 2
+        t['enc-part']['cipher'] = 'x' * 200
+        return t
+
+    def ap_req(tkt):
+        req = APReq()
+        req['pvno'] = 5
+        req['msg-type'] = 14
+        req['ap-options'] = "'0'B"
+        req['ticket'] = tkt
+        req['authenticator'] = None
+        req['authenticator']['etype'] = 18
+        req['authenticator']['cipher'] = 'y' * 100
+        return req
+
+    def tgs_req(tkt):
+        req = TGSReq()
+        req['pvno'] = 5
+        req['msg-type'] = 12
+        req['req-body'] = None
+        body = req['req-body']
+        body['kdc-options'] = "'0'B"
+        body['realm'] = 'KRBTEST.COM'
+        body['till'] = '20370101000000Z'
+        body['nonce'] = 1
+        body['etype'] = None
+        body['etype'][0] = 18
+        body['additional-tickets'] = None
+        body['additional-tickets'][0] = tkt
+        return req
+
+    # Frozen values encode exactly as unfrozen ones do, on their own
+    # and within other messages.
+    plain = ticket()
+    frozen = ticket().freeze()
+    assert(frozen.isFrozen() and not plain.isFrozen())
+    assert(frozen['sname'].isFrozen() and frozen['enc-part'].isFrozen())
+    assert(encoder.encode(frozen) == encoder.encode(plain))
+    assert(encoder.encode(ap_req(frozen)) == encoder.encode(ap_req(plain)))
+    assert(encoder.encode(tgs_req(frozen)) == encoder.encode(tgs_req(plain)))
+    dec = decoder.decode(encoder.encode(ap_req(frozen)), asn1Spec=APReq())[0]
+    assert(encoder.encode(dec) == encoder.encode(ap_req(plain)))
+
+    # Explicitly tagged clones share the cached encoding, which is
+    # used in place of the components.
+    req = ap_req(frozen)
+    assert(req['ticket'].isFrozen())
+    assert(req['ticket']._frozen is frozen._frozen)
+    spliced = ticket().freeze(frozen._frozen.replace('KRBTEST', 'EXAMPLE'))
+    assert('EXAMPLE.COM' in encoder.encode(ap_req(spliced)))
+
+    # Frozen values and their nested sequences cannot be modified.
+    for value, field, v in ((frozen, 'realm', 'OTHER.COM'),
+                            (frozen['sname'], 'name-type', 1),
+                            (frozen['enc-part'], 'kvno', 3),
+                            (req['ticket'], 'tkt-vno', 4)):
+        try:
+            value[field] = v
+            assert(False)
+        except FrozenValueError:
+            pass
+    assert(encoder.encode(frozen) == encoder.encode(plain))
@@ -0,0 +1,308 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module provides the low-level cryptographic primitives used by
+# crypto.py, implemented by whichever libraries are installed.  Each
+# backend maps primitive names to functions:
+#
+#   md4, md5, sha1: f(data) -> digest
+#   hmac-md5, hmac-sha1: f(key, data) -> mac
+#   pbkdf2-sha1: f(password, salt, length, iterations) -> bytes
+#   aes-cbc-encrypt, aes-cbc-decrypt: f(key, iv, data) -> bytes
+#   des3-cbc-encrypt, des3-cbc-decrypt: f(key, iv, data) -> bytes
+#   rc4: f(key, data) -> bytes
+#
+# The CBC primitives do no padding; data must be a multiple of the
+# block size.  current maps each primitive to the implementation in
+# use.  By default the first backend in _preference which supports a
+# primitive is used, and its modules are not imported until the
+# primitive is first needed.  select() overrides the choice, and
+# calibrate() picks the fastest implementation of each primitive.  If
+# the environment variable PYK5_CRYPTO_BACKEND is set to a backend
+# name, that backend is selected at import time; if
+# PYK5_CRYPTO_CALIBRATE is set, calibrate() is run at import time.
+
+import os
+import time
+import warnings
+
+
+PRIMITIVES = ('md4', 'md5', 'sha1', 'hmac-md5', 'hmac-sha1', 'pbkdf2-sha1',
+              'aes-cbc-encrypt', 'aes-cbc-decrypt', 'des3-cbc-encrypt',
+              'des3-cbc-decrypt', 'rc4')
+
+_HASHES = ('md4', 'md5', 'sha1', 'hmac-md5', 'hmac-sha1')
+_AES = ('aes-cbc-encrypt', 'aes-cbc-decrypt')
+_DES3 = ('des3-cbc-encrypt', 'des3-cbc-decrypt')
+
+
+# Each backend is split into groups of primitives, so that the modules
+# for a group are only imported when one of its primitives is first
+# used.  A group loader returns a dictionary of the primitives it can
+# provide, or raises ImportError.
+
+def _pycrypto_hashes():
+    from Crypto.Hash import HMAC, MD4, MD5, SHA
+    return {
+        'md4': lambda data: MD4.new(data).digest(),
+        'md5': lambda data: MD5.new(data).digest(),
+        'sha1': lambda data: SHA.new(data).digest(),
+        'hmac-md5': lambda key, data: HMAC.new(key, data, MD5).digest(),
+        'hmac-sha1': lambda key, data: HMAC.new(key, data, SHA).digest()
+    }
+
+
+def _pycrypto_pbkdf2():
+    from Crypto.Hash import HMAC, SHA
+    from Crypto.Protocol.KDF import PBKDF2
+
+    def pbkdf2(password, salt, length, iterations):
+        prf = lambda p, s: HMAC.new(p, s, SHA).digest()
+        return PBKDF2(password, salt, length, iterations, prf)
+
+    return {'pbkdf2-sha1': pbkdf2}
+
+
+def _pycrypto_aes():
+    from Crypto.Cipher import AES
+    return {
+        'aes-cbc-encrypt':
+            lambda key, iv, data: AES.new(key, AES.MODE_CBC, iv).encrypt(data),
+        'aes-cbc-decrypt':
+            lambda key, iv, data: AES.new(key, AES.MODE_CBC, iv).decrypt(data)
+    }
+
+
+def _pycrypto_des3():
+    from Crypto.Cipher import DES3
+    return {
+        'des3-cbc-encrypt':
+            lambda key, iv, data: DES3.new(key, DES3.MODE_CBC,
+                                           iv).encrypt(data),
+        'des3-cbc-decrypt':
+            lambda key, iv, data: DES3.new(key, DES3.MODE_CBC,
+                                           iv).decrypt(data)
+    }
+
+
+def _pycrypto_rc4():
+    from Crypto.Cipher import ARC4
+    return {'rc4': lambda key, data: ARC4.new(key).encrypt(data)}
+
+
+def _hashlib_hashes():
+    import hashlib
+    import hmac
+
+    prims = {
+        'md5': lambda data: hashlib.md5(data).digest(),
+        'sha1': lambda data: hashlib.sha1(data).digest(),
+        'hmac-md5': lambda key, data: hmac.new(key, data,
+                                               hashlib.md5).digest(),
+        'hmac-sha1': lambda key, data: hmac.new(key, data,
+                                                hashlib.sha1).digest()
+    }
+    # MD4 is missing from some OpenSSL builds.
+    try:
+        hashlib.new('md4', '')
+        prims['md4'] = lambda data: hashlib.new('md4', data).digest()
+    except ValueError:
+        pass
+    return prims
+
+
+def _hashlib_pbkdf2():
+    import hashlib
+    if not hasattr(hashlib, 'pbkdf2_hmac'):
+        return {}
+
+    def pbkdf2(password, salt, length, iterations):
+        return hashlib.pbkdf2_hmac('sha1', password, salt, iterations, length)
+
+    return {'pbkdf2-sha1': pbkdf2}
+
+
+def _cryptography_ciphers():
+    # Newer releases of cryptography warn on import under Python 2.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+    from cryptography.hazmat.primitives.ciphers import modes
+    backend = default_backend()
+
+    def cbc(alg, encrypt):
+        def f(key, iv, data):
+            c = Cipher(alg(key), modes.CBC(iv), backend=backend)
+            ctx = c.encryptor() if encrypt else c.decryptor()
+            return ctx.update(data) + ctx.finalize()
+        return f
+
+    def rc4(key, data):
+        ctx = Cipher(algorithms.ARC4(key), None, backend=backend).encryptor()
+        return ctx.update(data) + ctx.finalize()
+
+    return {
+        'aes-cbc-encrypt': cbc(algorithms.AES, True),
+        'aes-cbc-decrypt': cbc(algorithms.AES, False),
+        'des3-cbc-encrypt': cbc(algorithms.TripleDES, True),
+        'des3-cbc-decrypt': cbc(algorithms.TripleDES, False),
+        'rc4': rc4
+    }
+
+
+# Backends in order of preference, with their primitive groups.
+_preference = (
+    ('hashlib', ((_HASHES, _hashlib_hashes),
+                 (('pbkdf2-sha1',), _hashlib_pbkdf2))),
+    ('pycrypto', ((_HASHES, _pycrypto_hashes),
+                  (('pbkdf2-sha1',), _pycrypto_pbkdf2),
+                  (_AES, _pycrypto_aes),
+                  (_DES3, _pycrypto_des3),
+                  (('rc4',), _pycrypto_rc4))),
+    ('cryptography', ((_AES + _DES3 + ('rc4',), _cryptography_ciphers),))
+)
+_groups = dict(_preference)
+
+# Results of group loaders, or None for groups which failed to import.
+_loaded = {}
+
+
+def _load(name, prim):
+    # Return backend name's implementation of prim, or None.
+    for prims, loader in _groups[name]:
+        if prim in prims:
+            if loader not in _loaded:
+                try:
+                    _loaded[loader] = loader()
+                except ImportError:
+                    _loaded[loader] = None
+            impls = _loaded[loader]
+            return impls.get(prim) if impls is not None else None
+    return None
+
+
+class _Current(dict):
+    # Map primitives to the implementations in use, choosing the
+    # default implementation of a primitive on first use.
+    def __missing__(self, prim):
+        for name, groups in _preference:
+            f = _load(name, prim)
+            if f is not None:
+                self[prim] = f
+                return f
+        raise ValueError('No crypto backend implements %s' % prim)
+
+
+current = _Current()
+
+
+def _implementations(name):
+    # Load and return all of backend name's primitives.
+    return dict((prim, f) for prim, f in
+                ((prim, _load(name, prim)) for prim in PRIMITIVES)
+                if f is not None)
+
+
+def available():
+    # Return the names of the usable backends, in preference order.
+    # This imports every backend's modules.
+    return [name for name, groups in _preference if _implementations(name)]
+
+
+def supported(name):
+    # Return the primitives implemented by backend name.
+    return sorted(_implementations(name).keys())
+
+
+def select(name=None, primitives=None):
+    # Use backend name for the given primitives, or for all the
+    # primitives it implements.  With no name, restore the default
+    # choices.
+    if name is None:
+        current.clear()
+        return
+    if name not in _groups:
+        raise ValueError('Unknown crypto backend %s' % name)
+    impls = _implementations(name)
+    if not impls:
+        raise ValueError('Crypto backend %s is not available' % name)
+    for prim in (impls.keys() if primitives is None else primitives):
+        if prim not in impls:
+            raise ValueError('Backend %s does not implement %s' % (name, prim))
+        current[prim] = impls[prim]
+
+
+_calibration_args = {
+    'md4': ('x' * 1024,),
+    'md5': ('x' * 1024,),
+    'sha1': ('x' * 1024,),
+    'hmac-md5': ('k' * 16, 'x' * 1024),
+    'hmac-sha1': ('k' * 16, 'x' * 1024),
+    'pbkdf2-sha1': ('password', 'salt', 32, 64),
+    'aes-cbc-encrypt': ('k' * 16, '\0' * 16, 'x' * 1024),
+    'aes-cbc-decrypt': ('k' * 16, '\0' * 16, 'x' * 1024),
+    'des3-cbc-encrypt': ('k' * 24, '\0' * 8, 'x' * 1024),
+    'des3-cbc-decrypt': ('k' * 24, '\0' * 8, 'x' * 1024),
+    'rc4': ('k' * 16, 'x' * 1024)
+}
+
+
+def calibrate(duration=0.01):
+    # Time each implementation of each primitive for about duration
+    # seconds, select the fastest, and return a dictionary mapping
+    # primitives to the chosen backend names.
+    choices = {}
+    for prim in PRIMITIVES:
+        args = _calibration_args[prim]
+        best = None
+        for name in available():
+            f = _load(name, prim)
+            if f is None:
+                continue
+            count = 0
+            start = time.time()
+            while True:
+                f(*args)
+                count += 1
+                elapsed = time.time() - start
+                if elapsed >= duration:
+                    break
+            rate = count / elapsed
+            if best is None or rate > best[0]:
+                best = (rate, name)
+        if best is not None:
+            current[prim] = _load(best[1], prim)
+            choices[prim] = best[1]
+    return choices
+
+
+if os.environ.get('PYK5_CRYPTO_BACKEND'):
+    select(os.environ['PYK5_CRYPTO_BACKEND'])
+if os.environ.get('PYK5_CRYPTO_CALIBRATE'):
+    calibrate()
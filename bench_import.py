@@ -0,0 +1,70 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Measure the time taken to import the pyk5 modules in a fresh
+# interpreter, and the time taken by the first use of each enctype
+# (which loads the crypto backend modules it needs).  Usage:
+#
+#   python bench_import.py [runs]
+
+import subprocess
+import sys
+
+
+_script = '''
+import time
+start = time.time()
+import %s
+print(time.time() - start)
+'''
+
+_first_use = '''
+import time
+import crypto
+start = time.time()
+crypto.encrypt(crypto.Key(%d, '\\0' * %d), 1, 'plaintext')
+print(time.time() - start)
+'''
+
+
+def _median_run(code, runs):
+    times = sorted(float(subprocess.check_output([sys.executable, '-c',
+                                                  code]))
+                   for i in xrange(runs))
+    return times[len(times) // 2]
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 21
+    for mod in ('asn1', 'crypto', 'gss', 'kdcclient'):
+        t = _median_run(_script % mod, runs)
+        print('import %-10s %8.2f ms' % (mod, t * 1000))
+    for name, enctype, keysize in (('aes256', 18, 32), ('des3', 16, 24),
+                                   ('rc4', 23, 16)):
+        t = _median_run(_first_use % (enctype, keysize), runs)
+        print('first %-11s %8.2f ms' % (name, t * 1000))
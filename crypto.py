@@ -40,12 +40,12 @@
 #   - Cipher state only needed for kcmd suite
 #   - Nonstandard enctypes and cksumtypes like des-hmac-sha1
 
-from fractions import gcd
 from struct import pack, unpack
-from Crypto.Cipher import AES, DES3, ARC4
-from Crypto.Hash import HMAC, MD4, MD5, SHA
-from Crypto.Protocol.KDF import PBKDF2
-from Crypto.Random import get_random_bytes
+from collections import OrderedDict
+from threading import Lock
+from weakref import WeakValueDictionary, ref
+from backends import current as _prim
+from randpool import get_bytes as get_random_bytes
 
 
 class Enctype(object):
@@ -89,14 +89,23 @@ def _xorbytes(b1, b2):
 
 def _mac_equal(mac1, mac2):
     # Constant-time comparison function.  (We can't use HMAC.verify
-    # since we use truncated macs.)
-    assert len(mac1) == len(mac2)
+    # since we use truncated macs.)  MAC lengths are public, so a
+    # length mismatch may return early.
+    if len(mac1) != len(mac2):
+        return False
     res = 0
     for x, y in zip(mac1, mac2):
         res |= ord(x) ^ ord(y)
     return res == 0
 
 
+def _gcd(a, b):
+    # (fractions.gcd would import the decimal module.)
+    while b:
+        a, b = b, a % b
+    return a
+
+
 def _nfold(str, nbytes):
     # Convert str to a string of length nbytes using the RFC 3961 nfold
     # operation.
@@ -123,7 +132,7 @@ def _nfold(str, nbytes):
     # into slices of length nbytes, and add them together as
     # big-endian ones' complement integers.
     slen = len(str)
-    lcm = nbytes * slen / gcd(nbytes, slen)
+    lcm = nbytes * slen / _gcd(nbytes, slen)
     bigstr = ''.join((rotate_right(str, 13 * i) for i in xrange(lcm / slen)))
     slices = (bigstr[p:p+nbytes] for p in xrange(0, lcm, nbytes))
     return reduce(add_ones_complement, slices)
@@ -173,7 +182,7 @@ class _SimplifiedEnctype(_EnctypeProfile):
     #   * blocksize: Underlying cipher block size in bytes
     #   * padsize: Underlying cipher padding multiple (1 or blocksize)
     #   * macsize: Size of integrity MAC in bytes
-    #   * hashmod: PyCrypto hash module for underlying hash function
+    #   * hashname: Backend primitive name of underlying hash function
     #   * basic_encrypt, basic_decrypt: Underlying CBC/CTS cipher
 
     @classmethod
@@ -191,27 +200,39 @@ class _SimplifiedEnctype(_EnctypeProfile):
             plaintext = ciphertext
         return cls.random_to_key(rndseed[0:cls.seedsize])
 
+    @classmethod
+    def usage_keys(cls, key, keyusage):
+        # Return the integrity and encryption keys for keyusage.
+        return (cls.derive(key, pack('>iB', keyusage, 0x55)),
+                cls.derive(key, pack('>iB', keyusage, 0xAA)))
+
     @classmethod
     def encrypt(cls, key, keyusage, plaintext, confounder):
-        ki = cls.derive(key, pack('>iB', keyusage, 0x55))
-        ke = cls.derive(key, pack('>iB', keyusage, 0xAA))
+        ki, ke = cls.usage_keys(key, keyusage)
+        return cls.encrypt_derived(ki, ke, plaintext, confounder)
+
+    @classmethod
+    def encrypt_derived(cls, ki, ke, plaintext, confounder):
         if confounder is None:
             confounder = get_random_bytes(cls.blocksize)
         basic_plaintext = confounder + _zeropad(plaintext, cls.padsize)
-        hmac = HMAC.new(ki.contents, basic_plaintext, cls.hashmod).digest()
+        hmac = _prim['hmac-' + cls.hashname](ki.contents, basic_plaintext)
         return cls.basic_encrypt(ke, basic_plaintext) + hmac[:cls.macsize]
 
     @classmethod
     def decrypt(cls, key, keyusage, ciphertext):
-        ki = cls.derive(key, pack('>iB', keyusage, 0x55))
-        ke = cls.derive(key, pack('>iB', keyusage, 0xAA))
+        ki, ke = cls.usage_keys(key, keyusage)
+        return cls.decrypt_derived(ki, ke, ciphertext)
+
+    @classmethod
+    def decrypt_derived(cls, ki, ke, ciphertext):
         if len(ciphertext) < cls.blocksize + cls.macsize:
             raise ValueError('ciphertext too short')
         basic_ctext, mac = ciphertext[:-cls.macsize], ciphertext[-cls.macsize:]
         if len(basic_ctext) % cls.padsize != 0:
             raise ValueError('ciphertext does not meet padding requirement')
         basic_plaintext = cls.basic_decrypt(ke, basic_ctext)
-        hmac = HMAC.new(ki.contents, basic_plaintext, cls.hashmod).digest()
+        hmac = _prim['hmac-' + cls.hashname](ki.contents, basic_plaintext)
         expmac = hmac[:cls.macsize]
         if not _mac_equal(mac, expmac):
             raise InvalidChecksum('ciphertext integrity failure')
@@ -220,12 +241,15 @@ class _SimplifiedEnctype(_EnctypeProfile):
 
     @classmethod
     def prf(cls, key, string):
+        return cls.prf_derived(cls.derive(key, 'prf'), string)
+
+    @classmethod
+    def prf_derived(cls, kp, string):
         # Hash the input.  RFC 3961 says to truncate to the padding
         # size, but implementations truncate to the block size.
-        hashval = cls.hashmod.new(string).digest()
+        hashval = _prim[cls.hashname](string)
         truncated = hashval[:-(len(hashval) % cls.blocksize)]
-        # Encrypt the hash with a derived key.
-        kp = cls.derive(key, 'prf')
+        # Encrypt the hash with the derived prf key.
         return cls.basic_encrypt(kp, truncated)
 
 
@@ -236,7 +260,7 @@ class _DES3CBC(_SimplifiedEnctype):
     blocksize = 8
     padsize = 8
     macsize = 20
-    hashmod = SHA
+    hashname = 'sha1'
 
     @classmethod
     def random_to_key(cls, seed):
@@ -271,14 +295,12 @@ class _DES3CBC(_SimplifiedEnctype):
     @classmethod
     def basic_encrypt(cls, key, plaintext):
         assert len(plaintext) % 8 == 0
-        des3 = DES3.new(key.contents, AES.MODE_CBC, '\0' * 8)
-        return des3.encrypt(plaintext)
+        return _prim['des3-cbc-encrypt'](key.contents, '\0' * 8, plaintext)
 
     @classmethod
     def basic_decrypt(cls, key, ciphertext):
         assert len(ciphertext) % 8 == 0
-        des3 = DES3.new(key.contents, AES.MODE_CBC, '\0' * 8)
-        return des3.decrypt(ciphertext)
+        return _prim['des3-cbc-decrypt'](key.contents, '\0' * 8, ciphertext)
 
 
 class _AESEnctype(_SimplifiedEnctype):
@@ -286,21 +308,20 @@ class _AESEnctype(_SimplifiedEnctype):
     blocksize = 16
     padsize = 1
     macsize = 12
-    hashmod = SHA
+    hashname = 'sha1'
 
     @classmethod
     def string_to_key(cls, string, salt, params):
         (iterations,) = unpack('>L', params or '\x00\x00\x10\x00')
-        prf = lambda p, s: HMAC.new(p, s, SHA).digest()
-        seed = PBKDF2(string, salt, cls.seedsize, iterations, prf)
+        seed = _prim['pbkdf2-sha1'](string, salt, cls.seedsize, iterations)
         tkey = cls.random_to_key(seed)
         return cls.derive(tkey, 'kerberos')
 
     @classmethod
     def basic_encrypt(cls, key, plaintext):
         assert len(plaintext) >= 16
-        aes = AES.new(key.contents, AES.MODE_CBC, '\0' * 16)
-        ctext = aes.encrypt(_zeropad(plaintext, 16))
+        ctext = _prim['aes-cbc-encrypt'](key.contents, '\0' * 16,
+                                         _zeropad(plaintext, 16))
         if len(plaintext) > 16:
             # Swap the last two ciphertext blocks and truncate the
             # final block to match the plaintext length.
@@ -311,29 +332,32 @@ class _AESEnctype(_SimplifiedEnctype):
     @classmethod
     def basic_decrypt(cls, key, ciphertext):
         assert len(ciphertext) >= 16
-        aes = AES.new(key.contents, AES.MODE_ECB)
+        cbc_decrypt = _prim['aes-cbc-decrypt']
+        zeroiv = '\0' * 16
         if len(ciphertext) == 16:
-            return aes.decrypt(ciphertext)
-        # Split the ciphertext into blocks.  The last block may be partial.
-        cblocks = [ciphertext[p:p+16] for p in xrange(0, len(ciphertext), 16)]
-        lastlen = len(cblocks[-1])
+            return cbc_decrypt(key.contents, zeroiv, ciphertext)
+        # Split off the last two blocks.  The last block may be partial.
+        lastlen = len(ciphertext) % 16 or 16
+        headlen = len(ciphertext) - 16 - lastlen
+        head = ciphertext[:headlen]
+        cblock2 = ciphertext[headlen:headlen+16]
+        cblock1 = ciphertext[headlen+16:]
         # CBC-decrypt all but the last two blocks.
-        prev_cblock = '\0' * 16
-        plaintext = ''
-        for b in cblocks[:-2]:
-            plaintext += _xorbytes(aes.decrypt(b), prev_cblock)
-            prev_cblock = b
+        plaintext = cbc_decrypt(key.contents, zeroiv, head) if head else ''
+        prev_cblock = head[-16:] if head else zeroiv
         # Decrypt the second-to-last cipher block.  The left side of
         # the decrypted block will be the final block of plaintext
         # xor'd with the final partial cipher block; the right side
         # will be the omitted bytes of ciphertext from the final
-        # block.
-        b = aes.decrypt(cblocks[-2])
-        lastplaintext =_xorbytes(b[:lastlen], cblocks[-1])
+        # block.  (A single-block CBC decryption with a zero IV is a
+        # raw block decryption.)
+        b = cbc_decrypt(key.contents, zeroiv, cblock2)
+        lastplaintext =_xorbytes(b[:lastlen], cblock1)
         omitted = b[lastlen:]
-        # Decrypt the final cipher block plus the omitted bytes to get
-        # the second-to-last plaintext block.
-        plaintext += _xorbytes(aes.decrypt(cblocks[-1] + omitted), prev_cblock)
+        # Decrypt the final cipher block plus the omitted bytes, using
+        # the previous cipher block as the IV, to get the
+        # second-to-last plaintext block.
+        plaintext += cbc_decrypt(key.contents, prev_cblock, cblock1 + omitted)
         return plaintext + lastplaintext
 
 
@@ -365,31 +389,33 @@ class _RC4(_EnctypeProfile):
     @classmethod
     def string_to_key(cls, string, salt, params):
         utf16string = string.decode('UTF-8').encode('UTF-16LE')
-        return Key(cls.enctype, MD4.new(utf16string).digest())
+        return Key(cls.enctype, _prim['md4'](utf16string))
 
     @classmethod
     def encrypt(cls, key, keyusage, plaintext, confounder):
         if confounder is None:
             confounder = get_random_bytes(8)
-        ki = HMAC.new(key.contents, cls.usage_str(keyusage), MD5).digest()
-        cksum = HMAC.new(ki, confounder + plaintext, MD5).digest()
-        ke = HMAC.new(ki, cksum, MD5).digest()
-        return cksum + ARC4.new(ke).encrypt(confounder + plaintext)
+        hmac_md5 = _prim['hmac-md5']
+        ki = hmac_md5(key.contents, cls.usage_str(keyusage))
+        cksum = hmac_md5(ki, confounder + plaintext)
+        ke = hmac_md5(ki, cksum)
+        return cksum + _prim['rc4'](ke, confounder + plaintext)
 
     @classmethod
     def decrypt(cls, key, keyusage, ciphertext):
         if len(ciphertext) < 24:
             raise ValueError('ciphertext too short')
         cksum, basic_ctext = ciphertext[:16], ciphertext[16:]
-        ki = HMAC.new(key.contents, cls.usage_str(keyusage), MD5).digest()
-        ke = HMAC.new(ki, cksum, MD5).digest()
-        basic_plaintext = ARC4.new(ke).decrypt(basic_ctext)
-        exp_cksum = HMAC.new(ki, basic_plaintext, MD5).digest()
+        hmac_md5 = _prim['hmac-md5']
+        ki = hmac_md5(key.contents, cls.usage_str(keyusage))
+        ke = hmac_md5(ki, cksum)
+        basic_plaintext = _prim['rc4'](ke, basic_ctext)
+        exp_cksum = hmac_md5(ki, basic_plaintext)
         ok = _mac_equal(cksum, exp_cksum)
         if not ok and keyusage == 9:
             # Try again with usage 8, due to RFC 4757 errata.
-            ki = HMAC.new(key.contents, pack('<i', 8), MD5).digest()
-            exp_cksum = HMAC.new(ki, basic_plaintext, MD5).digest()
+            ki = hmac_md5(key.contents, pack('<i', 8))
+            exp_cksum = hmac_md5(ki, basic_plaintext)
             ok = _mac_equal(cksum, exp_cksum)
         if not ok:
             raise InvalidChecksum('ciphertext integrity failure')
@@ -398,16 +424,19 @@ class _RC4(_EnctypeProfile):
 
     @classmethod
     def prf(cls, key, string):
-        return HMAC.new(key.contents, string, SHA).digest()
+        return _prim['hmac-sha1'](key.contents, string)
 
 
 class _ChecksumProfile(object):
     # Base class for checksum profiles.  Usable checksum classes must
     # define:
+    #   * macsize: Size of checksum in bytes
     #   * checksum
     #   * verify (if verification is not just checksum-and-compare)
     @classmethod
     def verify(cls, key, keyusage, text, cksum):
+        if len(cksum) != cls.macsize:
+            raise InvalidChecksum('checksum has the wrong length')
         expected = cls.checksum(key, keyusage, text)
         if not _mac_equal(cksum, expected):
             raise InvalidChecksum('checksum verification failure')
@@ -423,7 +452,11 @@ class _SimplifiedChecksum(_ChecksumProfile):
     @classmethod
     def checksum(cls, key, keyusage, text):
         kc = cls.enc.derive(key, pack('>iB', keyusage, 0x99))
-        hmac = HMAC.new(kc.contents, text, cls.enc.hashmod).digest()
+        return cls.checksum_derived(kc, text)
+
+    @classmethod
+    def checksum_derived(cls, kc, text):
+        hmac = _prim['hmac-' + cls.enc.hashname](kc.contents, text)
         return hmac[:cls.macsize]
 
     @classmethod
@@ -449,11 +482,13 @@ class _SHA1DES3(_SimplifiedChecksum):
 
 
 class _HMACMD5(_ChecksumProfile):
+    macsize = 16
+
     @classmethod
     def checksum(cls, key, keyusage, text):
-        ksign = HMAC.new(key.contents, 'signaturekey\0', MD5).digest()
-        md5hash = MD5.new(_RC4.usage_str(keyusage) + text).digest()
-        return HMAC.new(ksign, md5hash, MD5).digest()
+        ksign = _prim['hmac-md5'](key.contents, 'signaturekey\0')
+        md5hash = _prim['md5'](_RC4.usage_str(keyusage) + text)
+        return _prim['hmac-md5'](ksign, md5hash)
 
     @classmethod
     def verify(cls, key, keyusage, text, cksum):
@@ -491,12 +526,45 @@ def _get_checksum_profile(cksumtype):
 
 
 class Key(object):
+    # Keys are immutable and compare and hash by value, so they can be
+    # used as dictionary keys.
+    __slots__ = ('enctype', 'contents', '__weakref__')
+
     def __init__(self, enctype, contents):
         e = _get_enctype_profile(enctype)
         if len(contents) != e.keysize:
             raise ValueError('Wrong key length')
-        self.enctype = enctype
-        self.contents = contents
+        object.__setattr__(self, 'enctype', enctype)
+        object.__setattr__(self, 'contents', contents)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Key objects are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Key objects are immutable')
+
+    def __eq__(self, other):
+        return (isinstance(other, Key) and self.enctype == other.enctype and
+                self.contents == other.contents)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.enctype, self.contents))
+
+    def __reduce__(self):
+        return (Key, (self.enctype, self.contents))
+
+
+_interned_keys = WeakValueDictionary()
+
+
+def intern_key(key):
+    # Return the interned Key equal to key, interning key if there is
+    # none.  Interned keys are held only as long as they are in use
+    # elsewhere.
+    return _interned_keys.setdefault((key.enctype, key.contents), key)
 
 
 def seedsize(enctype):
@@ -511,6 +579,11 @@ def random_to_key(enctype, seed):
     return e.random_to_key(seed)
 
 
+def random_key(enctype):
+    # Return a new random key, such as a session key.
+    return random_to_key(enctype, get_random_bytes(seedsize(enctype)))
+
+
 def string_to_key(enctype, string, salt, params=None):
     e = _get_enctype_profile(enctype)
     return e.string_to_key(string, salt, params)
@@ -546,19 +619,161 @@ def verify_checksum(cksumtype, key, keyusage, text, cksum):
     c.verify(key, keyusage, text, cksum)
 
 
-def prfplus(key, pepper, l):
-    # Produce l bytes of output using the RFC 6113 PRF+ function.
-    out = ''
+class DerivedKeys(object):
+    # The keys derived from a base key for a single key usage, for
+    # callers which encrypt or checksum many messages with the same
+    # key and usage.  Keys are derived on first use.  Enctypes which
+    # do not use the simplified profile fall back to the base key.
+    def __init__(self, key, keyusage):
+        self.key = key
+        self.keyusage = keyusage
+        self._enc = _get_enctype_profile(key.enctype)
+        self._simplified = issubclass(self._enc, _SimplifiedEnctype)
+        self._kike = None
+        self._kc = None
+
+    def _usage_keys(self):
+        if self._kike is None:
+            self._kike = self._enc.usage_keys(self.key, self.keyusage)
+        return self._kike
+
+    def encrypt(self, plaintext, confounder=None):
+        if not self._simplified:
+            return encrypt(self.key, self.keyusage, plaintext, confounder)
+        ki, ke = self._usage_keys()
+        return self._enc.encrypt_derived(ki, ke, plaintext, confounder)
+
+    def decrypt(self, ciphertext):
+        if not self._simplified:
+            return decrypt(self.key, self.keyusage, ciphertext)
+        ki, ke = self._usage_keys()
+        return self._enc.decrypt_derived(ki, ke, ciphertext)
+
+    def checksum(self, cksumtype, text):
+        c = _get_checksum_profile(cksumtype)
+        if (not issubclass(c, _SimplifiedChecksum) or
+            c.enc.enctype != self.key.enctype):
+            return c.checksum(self.key, self.keyusage, text)
+        if self._kc is None:
+            self._kc = self._enc.derive(self.key,
+                                        pack('>iB', self.keyusage, 0x99))
+        return c.checksum_derived(self._kc, text)
+
+    def verify(self, cksumtype, text, cksum):
+        c = _get_checksum_profile(cksumtype)
+        if (not issubclass(c, _SimplifiedChecksum) or
+            c.enc.enctype != self.key.enctype):
+            c.verify(self.key, self.keyusage, text, cksum)
+        elif len(cksum) != c.macsize:
+            raise InvalidChecksum('checksum has the wrong length')
+        elif not _mac_equal(cksum, self.checksum(cksumtype, text)):
+            raise InvalidChecksum('checksum verification failure')
+
+
+class _KeyMemo(object):
+    # A bounded LRU table of values computed from a Key and other
+    # arguments.  The table does not keep keys alive; when a key is
+    # garbage collected, its entries are dropped.  Equal keys share
+    # entries.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._refs = {}
+        self._dead = []
+
+    def _key_died(self, r):
+        # Called from the garbage collector, possibly while the lock
+        # is held, so just note the key for the next table operation.
+        self._dead.append(r)
+
+    def _purge(self):
+        while self._dead:
+            r = self._dead.pop()
+            canon, argset = self._refs.pop(r, (r, ()))
+            for args in argset:
+                self._entries.pop((r, args), None)
+
+    def get(self, key, args):
+        with self._lock:
+            self._purge()
+            canon = self._canonical(key)
+            if canon is None:
+                return None
+            value = self._entries.pop((canon, args), None)
+            if value is not None:
+                self._entries[(canon, args)] = value
+            return value
+
+    def put(self, key, args, value):
+        with self._lock:
+            self._purge()
+            canon = self._canonical(key)
+            if canon is None:
+                canon = ref(key, self._key_died)
+                self._refs[canon] = (canon, set())
+            self._entries[(canon, args)] = value
+            self._refs[canon][1].add(args)
+            while len(self._entries) > self.maxsize:
+                (r, a), v = self._entries.popitem(last=False)
+                argset = self._refs[r][1]
+                argset.discard(a)
+                if not argset:
+                    del self._refs[r]
+
+    def _canonical(self, key):
+        # Return the weak reference under which key's entries are
+        # stored, or None.  Weak references compare equal if their
+        # referents do.
+        entry = self._refs.get(ref(key))
+        return entry[0] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._refs.clear()
+            del self._dead[:]
+
+
+_prfplus_memo = _KeyMemo(4096)
+
+
+def _prfplus(key, pepper, l):
+    e = _get_enctype_profile(key.enctype)
+    if issubclass(e, _SimplifiedEnctype):
+        # Derive the prf key once rather than for every block.
+        kp = e.derive(key, 'prf')
+        prf = lambda s: e.prf_derived(kp, s)
+    else:
+        prf = lambda s: e.prf(key, s)
+    out = bytearray(l)
+    pos = 0
     count = 1
-    while len(out) < l:
-        out += prf(key, chr(count) + pepper)
+    while pos < l:
+        block = prf(chr(count) + pepper)
+        n = min(len(block), l - pos)
+        out[pos:pos+n] = block[:n]
+        pos += n
         count += 1
-    return out[:l]
+    return str(out)
+
+
+def prfplus(key, pepper, l):
+    # Produce l bytes of output using the RFC 6113 PRF+ function.
+    # Results are remembered for as long as the key is in use, since
+    # FAST uses the same key and pepper for many requests.
+    out = _prfplus_memo.get(key, (pepper, l))
+    if out is None:
+        out = _prfplus(key, pepper, l)
+        _prfplus_memo.put(key, (pepper, l), out)
+    return out
 
 
 def cf2(enctype, key1, key2, pepper1, pepper2):
     # Combine two keys and two pepper strings to produce a result key
-    # of type enctype, using the RFC 6113 KRB-FX-CF2 function.
+    # of type enctype, using the RFC 6113 KRB-FX-CF2 function.  The
+    # PRF+ outputs come from the prfplus memo table when the same keys
+    # and peppers are reused.
     e = _get_enctype_profile(enctype)
     return e.random_to_key(_xorbytes(prfplus(key1, pepper1, e.seedsize),
                                      prfplus(key2, pepper2, e.seedsize)))
@@ -568,145 +783,212 @@ if __name__ == '__main__':
     def h(hexstr):
         return hexstr.decode('hex')
 
-    # AES128 encrypt and decrypt
-    kb = h('9062430C8CDA3388922E6D6A509F5B7A')
-    conf = h('94B491F481485B9A0678CD3C4EA386AD')
-    keyusage = 2
-    plain = '9 bytesss'
-    ctxt = h('68FB9679601F45C78857B2BF820FD6E53ECA8D42FD4B1D7024A09205ABB7CD2E'
-             'C26C355D2F')
-    k = Key(Enctype.AES128, kb)
-    assert(encrypt(k, keyusage, plain, conf) == ctxt)
-    assert(decrypt(k, keyusage, ctxt) == plain)
-
-    # AES256 encrypt and decrypt
-    kb = h('F1C795E9248A09338D82C3F8D5B567040B0110736845041347235B1404231398')
-    conf = h('E45CA518B42E266AD98E165E706FFB60')
-    keyusage = 4
-    plain = '30 bytes bytes bytes bytes byt'
-    ctxt = h('D1137A4D634CFECE924DBC3BF6790648BD5CFF7DE0E7B99460211D0DAEF3D79A'
-             '295C688858F3B34B9CBD6EEBAE81DAF6B734D4D498B6714F1C1D')
-    k = Key(Enctype.AES256, kb)
-    assert(encrypt(k, keyusage, plain, conf) == ctxt)
-    assert(decrypt(k, keyusage, ctxt) == plain)
-
-    # AES128 checksum
-    kb = h('9062430C8CDA3388922E6D6A509F5B7A')
-    keyusage = 3
-    plain = 'eight nine ten eleven twelve thirteen'
-    cksum = h('01A4B088D45628F6946614E3')
-    k = Key(Enctype.AES128, kb)
-    verify_checksum(Cksumtype.SHA1_AES128, k, keyusage, plain, cksum)
-
-    # AES256 checksum
-    kb = h('B1AE4CD8462AFF1677053CC9279AAC30B796FB81CE21474DD3DDBCFEA4EC76D7')
-    keyusage = 4
-    plain = 'fourteen'
-    cksum = h('E08739E3279E2903EC8E3836')
-    k = Key(Enctype.AES256, kb)
-    verify_checksum(Cksumtype.SHA1_AES256, k, keyusage, plain, cksum)
-
-    # AES128 string-to-key
-    string = 'password'
-    salt = 'ATHENA.MIT.EDUraeburn'
-    params = h('00000002')
-    kb = h('C651BF29E2300AC27FA469D693BDDA13')
-    k = string_to_key(Enctype.AES128, string, salt, params)
-    assert(k.contents == kb)
-
-    # AES256 string-to-key
-    string = 'X' * 64
-    salt = 'pass phrase equals block size'
-    params = h('000004B0')
-    kb = h('89ADEE3608DB8BC71F1BFBFE459486B05618B70CBAE22092534E56C553BA4B34')
-    k = string_to_key(Enctype.AES256, string, salt, params)
-    assert(k.contents == kb)
-
-    # AES128 prf
-    kb = h('77B39A37A868920F2A51F9DD150C5717')
-    k = string_to_key(Enctype.AES128, 'key1', 'key1')
-    assert(prf(k, '\x01\x61') == kb)
-
-    # AES256 prf
-    kb = h('0D674DD0F9A6806525A4D92E828BD15A')
-    k = string_to_key(Enctype.AES256, 'key2', 'key2')
-    assert(prf(k, '\x02\x62') == kb)
-
-    # AES128 cf2
-    kb = h('97DF97E4B798B29EB31ED7280287A92A')
-    k1 = string_to_key(Enctype.AES128, 'key1', 'key1')
-    k2 = string_to_key(Enctype.AES128, 'key2', 'key2')
-    k = cf2(Enctype.AES128, k1, k2, 'a', 'b')
-    assert(k.contents == kb)
-
-    # AES256 cf2
-    kb = h('4D6CA4E629785C1F01BAF55E2E548566B9617AE3A96868C337CB93B5E72B1C7B')
-    k1 = string_to_key(Enctype.AES256, 'key1', 'key1')
-    k2 = string_to_key(Enctype.AES256, 'key2', 'key2')
-    k = cf2(Enctype.AES256, k1, k2, 'a', 'b')
-    assert(k.contents == kb)
-
-    # DES3 encrypt and decrypt
-    kb = h('0DD52094E0F41CECCB5BE510A764B35176E3981332F1E598')
-    conf = h('94690A17B2DA3C9B')
-    keyusage = 3
-    plain = '13 bytes byte'
-    ctxt = h('839A17081ECBAFBCDC91B88C6955DD3C4514023CF177B77BF0D0177A16F705E8'
-             '49CB7781D76A316B193F8D30')
-    k = Key(Enctype.DES3, kb)
-    assert(encrypt(k, keyusage, plain, conf) == ctxt)
-    assert(decrypt(k, keyusage, ctxt) == _zeropad(plain, 8))
-
-    # DES3 string-to-key
-    string = 'password'
-    salt = 'ATHENA.MIT.EDUraeburn'
-    kb = h('850BB51358548CD05E86768C313E3BFEF7511937DCF72C3E')
-    k = string_to_key(Enctype.DES3, string, salt)
-    assert(k.contents == kb)
-
-    # DES3 checksum
-    kb = h('7A25DF8992296DCEDA0E135BC4046E2375B3C14C98FBC162')
-    keyusage = 2
-    plain = 'six seven'
-    cksum = h('0EEFC9C3E049AABC1BA5C401677D9AB699082BB4')
-    k = Key(Enctype.DES3, kb)
-    verify_checksum(Cksumtype.SHA1_DES3, k, keyusage, plain, cksum)
-
-    # DES3 cf2
-    kb = h('E58F9EB643862C13AD38E529313462A7F73E62834FE54A01')
-    k1 = string_to_key(Enctype.DES3, 'key1', 'key1')
-    k2 = string_to_key(Enctype.DES3, 'key2', 'key2')
-    k = cf2(Enctype.DES3, k1, k2, 'a', 'b')
-    assert(k.contents == kb)
-
-    # RC4 encrypt and decrypt
-    kb = h('68F263DB3FCE15D031C9EAB02D67107A')
-    conf = h('37245E73A45FBF72')
-    keyusage = 4
-    plain = '30 bytes bytes bytes bytes byt'
-    ctxt = h('95F9047C3AD75891C2E9B04B16566DC8B6EB9CE4231AFB2542EF87A7B5A0F260'
-             'A99F0460508DE0CECC632D07C354124E46C5D2234EB8')
-    k = Key(Enctype.RC4, kb)
-    assert(encrypt(k, keyusage, plain, conf) == ctxt)
-    assert(decrypt(k, keyusage, ctxt) == plain)
-
-    # RC4 string-to-key
-    string = 'foo'
-    kb = h('AC8E657F83DF82BEEA5D43BDAF7800CC')
-    k = string_to_key(Enctype.RC4, string, None)
-    assert(k.contents == kb)
-
-    # RC4 checksum
-    kb = h('F7D3A155AF5E238A0B7A871A96BA2AB2')
-    keyusage = 6
-    plain = 'seventeen eighteen nineteen twenty'
-    cksum = h('EB38CC97E2230F59DA4117DC5859D7EC')
-    k = Key(Enctype.RC4, kb)
-    verify_checksum(Cksumtype.HMAC_MD5, k, keyusage, plain, cksum)
-
-    # RC4 cf2
-    kb = h('24D7F6B6BAE4E5C00D2082C5EBAB3672')
-    k1 = string_to_key(Enctype.RC4, 'key1', 'key1')
-    k2 = string_to_key(Enctype.RC4, 'key2', 'key2')
-    k = cf2(Enctype.RC4, k1, k2, 'a', 'b')
-    assert(k.contents == kb)
+    def run_tests():
+        # AES128 encrypt and decrypt
+        kb = h('9062430C8CDA3388922E6D6A509F5B7A')
+        conf = h('94B491F481485B9A0678CD3C4EA386AD')
+        keyusage = 2
+        plain = '9 bytesss'
+        ctxt = h('68FB9679601F45C78857B2BF820FD6E5'
+                 '3ECA8D42FD4B1D7024A09205ABB7CD2E'
+                 'C26C355D2F')
+        k = Key(Enctype.AES128, kb)
+        assert(encrypt(k, keyusage, plain, conf) == ctxt)
+        assert(decrypt(k, keyusage, ctxt) == plain)
+
+        # AES256 encrypt and decrypt
+        kb = h('F1C795E9248A09338D82C3F8D5B56704'
+               '0B0110736845041347235B1404231398')
+        conf = h('E45CA518B42E266AD98E165E706FFB60')
+        keyusage = 4
+        plain = '30 bytes bytes bytes bytes byt'
+        ctxt = h('D1137A4D634CFECE924DBC3BF6790648'
+                 'BD5CFF7DE0E7B99460211D0DAEF3D79A'
+                 '295C688858F3B34B9CBD6EEBAE81DAF6B734D4D498B6714F1C1D')
+        k = Key(Enctype.AES256, kb)
+        assert(encrypt(k, keyusage, plain, conf) == ctxt)
+        assert(decrypt(k, keyusage, ctxt) == plain)
+        dk = DerivedKeys(k, keyusage)
+        assert(dk.encrypt(plain, conf) == ctxt)
+        assert(dk.decrypt(ctxt) == plain)
+
+        # AES128 checksum
+        kb = h('9062430C8CDA3388922E6D6A509F5B7A')
+        keyusage = 3
+        plain = 'eight nine ten eleven twelve thirteen'
+        cksum = h('01A4B088D45628F6946614E3')
+        k = Key(Enctype.AES128, kb)
+        verify_checksum(Cksumtype.SHA1_AES128, k, keyusage, plain, cksum)
+        DerivedKeys(k, keyusage).verify(Cksumtype.SHA1_AES128, plain, cksum)
+        for bad in (cksum[:-1], cksum + '\0', ''):
+            for verify in (lambda c: verify_checksum(Cksumtype.SHA1_AES128,
+                                                     k, keyusage, plain, c),
+                           lambda c: DerivedKeys(k, keyusage).verify(
+                               Cksumtype.SHA1_AES128, plain, c)):
+                try:
+                    verify(bad)
+                    assert(False)
+                except InvalidChecksum:
+                    pass
+
+        # AES256 checksum
+        kb = h('B1AE4CD8462AFF1677053CC9279AAC30'
+               'B796FB81CE21474DD3DDBCFEA4EC76D7')
+        keyusage = 4
+        plain = 'fourteen'
+        cksum = h('E08739E3279E2903EC8E3836')
+        k = Key(Enctype.AES256, kb)
+        verify_checksum(Cksumtype.SHA1_AES256, k, keyusage, plain, cksum)
+
+        # AES128 string-to-key
+        string = 'password'
+        salt = 'ATHENA.MIT.EDUraeburn'
+        params = h('00000002')
+        kb = h('C651BF29E2300AC27FA469D693BDDA13')
+        k = string_to_key(Enctype.AES128, string, salt, params)
+        assert(k.contents == kb)
+
+        # AES256 string-to-key
+        string = 'X' * 64
+        salt = 'pass phrase equals block size'
+        params = h('000004B0')
+        kb = h('89ADEE3608DB8BC71F1BFBFE459486B0'
+               '5618B70CBAE22092534E56C553BA4B34')
+        k = string_to_key(Enctype.AES256, string, salt, params)
+        assert(k.contents == kb)
+
+        # AES128 prf
+        kb = h('77B39A37A868920F2A51F9DD150C5717')
+        k = string_to_key(Enctype.AES128, 'key1', 'key1')
+        assert(prf(k, '\x01\x61') == kb)
+
+        # AES256 prf
+        kb = h('0D674DD0F9A6806525A4D92E828BD15A')
+        k = string_to_key(Enctype.AES256, 'key2', 'key2')
+        assert(prf(k, '\x02\x62') == kb)
+
+        # AES128 cf2
+        kb = h('97DF97E4B798B29EB31ED7280287A92A')
+        k1 = string_to_key(Enctype.AES128, 'key1', 'key1')
+        k2 = string_to_key(Enctype.AES128, 'key2', 'key2')
+        k = cf2(Enctype.AES128, k1, k2, 'a', 'b')
+        assert(k.contents == kb)
+
+        # AES256 cf2
+        kb = h('4D6CA4E629785C1F01BAF55E2E548566'
+               'B9617AE3A96868C337CB93B5E72B1C7B')
+        k1 = string_to_key(Enctype.AES256, 'key1', 'key1')
+        k2 = string_to_key(Enctype.AES256, 'key2', 'key2')
+        k = cf2(Enctype.AES256, k1, k2, 'a', 'b')
+        assert(k.contents == kb)
+
+        # DES3 encrypt and decrypt
+        kb = h('0DD52094E0F41CECCB5BE510A764B35176E3981332F1E598')
+        conf = h('94690A17B2DA3C9B')
+        keyusage = 3
+        plain = '13 bytes byte'
+        ctxt = h('839A17081ECBAFBCDC91B88C6955DD3C'
+                 '4514023CF177B77BF0D0177A16F705E8'
+                 '49CB7781D76A316B193F8D30')
+        k = Key(Enctype.DES3, kb)
+        assert(encrypt(k, keyusage, plain, conf) == ctxt)
+        assert(decrypt(k, keyusage, ctxt) == _zeropad(plain, 8))
+
+        # DES3 string-to-key
+        string = 'password'
+        salt = 'ATHENA.MIT.EDUraeburn'
+        kb = h('850BB51358548CD05E86768C313E3BFEF7511937DCF72C3E')
+        k = string_to_key(Enctype.DES3, string, salt)
+        assert(k.contents == kb)
+
+        # DES3 checksum
+        kb = h('7A25DF8992296DCEDA0E135BC4046E2375B3C14C98FBC162')
+        keyusage = 2
+        plain = 'six seven'
+        cksum = h('0EEFC9C3E049AABC1BA5C401677D9AB699082BB4')
+        k = Key(Enctype.DES3, kb)
+        verify_checksum(Cksumtype.SHA1_DES3, k, keyusage, plain, cksum)
+
+        # DES3 cf2
+        kb = h('E58F9EB643862C13AD38E529313462A7F73E62834FE54A01')
+        k1 = string_to_key(Enctype.DES3, 'key1', 'key1')
+        k2 = string_to_key(Enctype.DES3, 'key2', 'key2')
+        k = cf2(Enctype.DES3, k1, k2, 'a', 'b')
+        assert(k.contents == kb)
+
+        # RC4 encrypt and decrypt
+        kb = h('68F263DB3FCE15D031C9EAB02D67107A')
+        conf = h('37245E73A45FBF72')
+        keyusage = 4
+        plain = '30 bytes bytes bytes bytes byt'
+        ctxt = h('95F9047C3AD75891C2E9B04B16566DC8'
+                 'B6EB9CE4231AFB2542EF87A7B5A0F260'
+                 'A99F0460508DE0CECC632D07C354124E46C5D2234EB8')
+        k = Key(Enctype.RC4, kb)
+        assert(encrypt(k, keyusage, plain, conf) == ctxt)
+        assert(decrypt(k, keyusage, ctxt) == plain)
+
+        # RC4 string-to-key
+        string = 'foo'
+        kb = h('AC8E657F83DF82BEEA5D43BDAF7800CC')
+        k = string_to_key(Enctype.RC4, string, None)
+        assert(k.contents == kb)
+
+        # RC4 checksum
+        kb = h('F7D3A155AF5E238A0B7A871A96BA2AB2')
+        keyusage = 6
+        plain = 'seventeen eighteen nineteen twenty'
+        cksum = h('EB38CC97E2230F59DA4117DC5859D7EC')
+        k = Key(Enctype.RC4, kb)
+        verify_checksum(Cksumtype.HMAC_MD5, k, keyusage, plain, cksum)
+        DerivedKeys(k, keyusage).verify(Cksumtype.HMAC_MD5, plain, cksum)
+
+        # RC4 cf2
+        kb = h('24D7F6B6BAE4E5C00D2082C5EBAB3672')
+        k1 = string_to_key(Enctype.RC4, 'key1', 'key1')
+        k2 = string_to_key(Enctype.RC4, 'key2', 'key2')
+        k = cf2(Enctype.RC4, k1, k2, 'a', 'b')
+        assert(k.contents == kb)
+
+    # Key equality, hashing, immutability, and interning
+    k1 = Key(Enctype.AES128, '\x01' * 16)
+    k2 = Key(Enctype.AES128, '\x01' * 16)
+    assert(k1 == k2 and k1 is not k2 and hash(k1) == hash(k2))
+    assert(k1 != Key(Enctype.AES128, '\x02' * 16))
+    assert(k1 != Key(Enctype.RC4, '\x01' * 16))
+    assert(len(set([k1, k2])) == 1)
+    try:
+        k1.contents = '\x02' * 16
+        assert(False)
+    except AttributeError:
+        pass
+    assert(intern_key(k1) is k1 and intern_key(k2) is k1)
+    import pickle
+    assert(pickle.loads(pickle.dumps(k1, 2)) == k1)
+
+    # prfplus memoization
+    k1 = Key(Enctype.AES128, '\x01' * 16)
+    out = prfplus(k1, 'pepper', 40)
+    assert(out == _prfplus(k1, 'pepper', 40) and len(out) == 40)
+    assert(prfplus(Key(Enctype.AES128, '\x01' * 16), 'pepper', 40) is out)
+    assert(len(_prfplus_memo._entries) == 1)
+    del k1
+    prfplus(Key(Enctype.AES128, '\x02' * 16), 'pepper', 40)
+    assert(len(_prfplus_memo._entries) == 1)
+    _prfplus_memo.clear()
+
+    # Random keys
+    for enctype in (Enctype.DES3, Enctype.AES128, Enctype.AES256,
+                    Enctype.RC4):
+        k1, k2 = random_key(enctype), random_key(enctype)
+        assert(k1.enctype == enctype and k1 != k2)
+        assert(decrypt(k1, 1, encrypt(k1, 1, 'sixteen byte msg')) ==
+               'sixteen byte msg')
+
+    # Run the known-answer tests with each available backend.
+    import backends
+    run_tests()
+    for name in backends.available():
+        backends.select(name)
+        run_tests()
+        backends.select()
@@ -0,0 +1,401 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module runs crypto operations off the calling thread, for
+# servers built around an event loop.  aencrypt(), adecrypt(),
+# astring_to_key() and averify_checksum() return a Future at once;
+# the work runs on a pool of worker threads or processes, and the
+# Future's done callbacks run in a pool thread when it completes (an
+# event loop would typically have them wake it through a pipe).
+# Operations on less than inline_size bytes are cheaper to do than to
+# hand off, so they run immediately and return a completed Future.
+#
+# Requests which arrive while every worker is busy are queued by key
+# and key usage (or, for string_to_key, by all of its arguments), and
+# each queue goes to the next free worker as one batch.  A batch
+# derives the usage keys once for all of its messages, and identical
+# string_to_key requests share a single computation.
+#
+# With a thread pool, pure-Python crypto still holds the interpreter
+# lock while it runs; use processes=True to keep long operations from
+# competing with the event loop thread.  Process pool batches are
+# pickled here and unpickled in the worker under our own error
+# handling, since a job which the pool itself fails to transfer would
+# never complete.
+
+import cPickle as pickle
+import multiprocessing
+import threading
+import traceback
+from collections import deque
+from functools import partial
+from multiprocessing.pool import ThreadPool
+import crypto
+
+
+class ResultTimeout(RuntimeError):
+    pass
+
+
+class Future(object):
+    # The eventual result of an operation.  result() returns the value
+    # or raises the exception the operation raised.
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._error = None
+        self._value = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise ResultTimeout('Crypto operation not finished')
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def add_done_callback(self, fn):
+        # Arrange for fn(future) to be called on completion, or call
+        # it now if the future is already done.
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set(self, error, value):
+        with self._lock:
+            self._error = error
+            self._value = value
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            # Callbacks run in a pool thread, which an exception would
+            # kill; report it as an uncaught thread exception would be.
+            try:
+                fn(self)
+            except Exception:
+                traceback.print_exc()
+
+
+def _run_now(fn, *args):
+    f = Future()
+    try:
+        f._set(None, fn(*args))
+    except Exception as e:
+        f._set(e, None)
+    return f
+
+
+def _run_batch(op, group, items):
+    # Run a batch of operations in a worker and return a list of
+    # (exception, result) pairs.  Exceptions are returned rather than
+    # raised because Pool.apply_async() has no error callback.
+    try:
+        if op == 'string_to_key':
+            return [(None, crypto.string_to_key(*group))] * len(items)
+        fn = getattr(crypto.DerivedKeys(*group), op)
+    except Exception as e:
+        return [(e, None)] * len(items)
+    out = []
+    for args in items:
+        try:
+            out.append((None, fn(*args)))
+        except Exception as e:
+            out.append((e, None))
+    return out
+
+
+def _run_pickled(data):
+    # Run a pickled batch in a worker process and return the pickled
+    # results.  Results which cannot be pickled become errors.
+    try:
+        op, group, items = pickle.loads(data)
+    except Exception as e:
+        return pickle.dumps(e, 2)
+    out = []
+    for error, value in _run_batch(op, group, items):
+        try:
+            pickle.dumps((error, value), 2)
+        except Exception as e:
+            error, value = RuntimeError('Unpicklable result: %s' % e), None
+        out.append((error, value))
+    return pickle.dumps(out, 2)
+
+
+def _bytes(arg):
+    # Copy buffers to strings, which can be pickled and which every
+    # crypto backend accepts.
+    if isinstance(arg, memoryview):
+        return arg.tobytes()
+    if isinstance(arg, buffer):
+        return str(arg)
+    return arg
+
+
+class CryptoExecutor(object):
+    # Run operations on a pool of workers threads (or processes if
+    # processes is set).  pool may instead be any object with the
+    # multiprocessing Pool apply_async(), close() and join() methods,
+    # with workers giving its size; set processes if it runs jobs in
+    # other processes.  Batches hold at most max_batch operations.
+    def __init__(self, workers=None, processes=False, inline_size=1024,
+                 max_batch=64, pool=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if pool is None:
+            pool = (multiprocessing.Pool if processes else ThreadPool)(workers)
+        self.workers = workers
+        self.inline_size = inline_size
+        self.max_batch = max_batch
+        self.pool = pool
+        self.processes = processes
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._queued = {}
+        self._order = deque()
+
+    def _submit(self, op, group, args):
+        f = Future()
+        args = tuple(_bytes(a) for a in args)
+        with self._lock:
+            q = self._queued.get((op, group))
+            if q is None:
+                q = self._queued[(op, group)] = []
+                self._order.append((op, group))
+            q.append((args, f))
+            self._dispatch()
+        return f
+
+    def _dispatch(self):
+        # Hand queued batches to free workers.  Called with the lock
+        # held.
+        while self._order and self._busy < self.workers:
+            k = self._order.popleft()
+            q = self._queued.pop(k)
+            batch = q[:self.max_batch]
+            if len(q) > self.max_batch:
+                self._queued[k] = q[self.max_batch:]
+                self._order.append(k)
+            op, group = k
+            job = (op, group, [a for a, f in batch])
+            if self.processes:
+                try:
+                    job = (pickle.dumps(job, 2),)
+                except Exception as e:
+                    for args, f in batch:
+                        f._set(e, None)
+                    continue
+            self._busy += 1
+            self.pool.apply_async(
+                _run_pickled if self.processes else _run_batch, job,
+                callback=partial(self._finished, batch))
+
+    def _finished(self, batch, results):
+        with self._lock:
+            self._busy -= 1
+            self._dispatch()
+        if self.processes:
+            try:
+                results = pickle.loads(results)
+            except Exception as e:
+                results = e
+            if isinstance(results, Exception):
+                results = [(results, None)] * len(batch)
+        for (args, f), (error, value) in zip(batch, results):
+            f._set(error, value)
+
+    def aencrypt(self, key, keyusage, plaintext, confounder=None):
+        if len(plaintext) < self.inline_size:
+            return _run_now(crypto.encrypt, key, keyusage, plaintext,
+                            confounder)
+        return self._submit('encrypt', (key, keyusage),
+                            (plaintext, confounder))
+
+    def adecrypt(self, key, keyusage, ciphertext):
+        if len(ciphertext) < self.inline_size:
+            return _run_now(crypto.decrypt, key, keyusage, ciphertext)
+        return self._submit('decrypt', (key, keyusage), (ciphertext,))
+
+    def averify_checksum(self, cksumtype, key, keyusage, text, cksum):
+        if len(text) < self.inline_size:
+            return _run_now(crypto.verify_checksum, cksumtype, key,
+                            keyusage, text, cksum)
+        return self._submit('verify', (key, keyusage),
+                            (cksumtype, text, cksum))
+
+    def astring_to_key(self, enctype, string, salt, params=None):
+        return self._submit('string_to_key', (enctype, string, salt, params),
+                            ())
+
+    def close(self):
+        # Wait for outstanding operations and stop the workers.
+        self.pool.close()
+        self.pool.join()
+
+
+_default = []
+_default_lock = threading.Lock()
+
+
+def default_executor():
+    # Return the executor used by the module-level functions, creating
+    # a thread pool executor on first use.
+    with _default_lock:
+        if not _default:
+            _default.append(CryptoExecutor())
+        return _default[0]
+
+
+def aencrypt(key, keyusage, plaintext, confounder=None):
+    return default_executor().aencrypt(key, keyusage, plaintext, confounder)
+
+
+def adecrypt(key, keyusage, ciphertext):
+    return default_executor().adecrypt(key, keyusage, ciphertext)
+
+
+def averify_checksum(cksumtype, key, keyusage, text, cksum):
+    return default_executor().averify_checksum(cksumtype, key, keyusage,
+                                               text, cksum)
+
+
+def astring_to_key(enctype, string, salt, params=None):
+    return default_executor().astring_to_key(enctype, string, salt, params)
+
+
+if __name__ == '__main__':
+    from crypto import Cksumtype, Enctype
+
+    # A pool which runs jobs only when told to, so that batching can
+    # be observed.
+    class ManualPool(object):
+        def __init__(self):
+            self.jobs = []
+
+        def apply_async(self, func, args, callback):
+            self.jobs.append((func, args, callback))
+
+        def run(self):
+            func, args, callback = self.jobs.pop(0)
+            callback(func(*args))
+
+    key = crypto.Key(Enctype.AES128, '\x01' * 16)
+    big = 'x' * 2000
+    pool = ManualPool()
+    ex = CryptoExecutor(workers=1, pool=pool)
+
+    # Small operations run inline.
+    f = ex.aencrypt(key, 3, 'small')
+    assert(f.done() and not pool.jobs)
+    assert(ex.adecrypt(key, 3, f.result()).result() == 'small')
+
+    # Requests made while the worker is busy are batched by key and
+    # usage, and string_to_key requests are merged.
+    first = ex.aencrypt(key, 3, big)
+    encs = [ex.aencrypt(key, 3, big) for i in xrange(5)]
+    other = ex.aencrypt(key, 4, big)
+    s2ks = [ex.astring_to_key(Enctype.AES128, 'pw', 'salt')
+            for i in xrange(3)]
+    assert(len(pool.jobs) == 1)
+    called = []
+    first.add_done_callback(called.append)
+    pool.run()
+    assert(called == [first] and len(pool.jobs) == 1)
+    assert(len(pool.jobs[0][1][2]) == 5)
+    while pool.jobs:
+        pool.run()
+    ctexts = [f.result() for f in [first] + encs]
+    assert(len(set(ctexts)) == 6)
+    assert(all(crypto.decrypt(key, 3, c) == big for c in ctexts))
+    assert(crypto.decrypt(key, 4, other.result()) == big)
+    assert(len(set(id(f.result()) for f in s2ks)) == 1)
+    assert(s2ks[0].result() == crypto.string_to_key(Enctype.AES128, 'pw',
+                                                      'salt'))
+
+    # Errors are delivered through the future.
+    cksum = crypto.make_checksum(Cksumtype.SHA1_AES128, key, 5, big)
+    f = ex.averify_checksum(Cksumtype.SHA1_AES128, key, 5, big, cksum)
+    pool.run()
+    f.result()
+    for text in ('short', big + 'x'):
+        f = ex.averify_checksum(Cksumtype.SHA1_AES128, key, 5, text, cksum)
+        while pool.jobs:
+            pool.run()
+        try:
+            f.result()
+            assert(False)
+        except crypto.InvalidChecksum:
+            pass
+    f = ex.adecrypt(key, 3, 'y' * 2000)
+    pool.run()
+    try:
+        f.result()
+        assert(False)
+    except crypto.InvalidChecksum:
+        pass
+
+    # A failing callback does not stop other callbacks or the pool.
+    import sys
+    from StringIO import StringIO
+    stderr, sys.stderr = sys.stderr, StringIO()
+    try:
+        f = ex.aencrypt(key, 3, big)
+        f.add_done_callback(lambda f: 1 / 0)
+        f.add_done_callback(called.append)
+        pool.run()
+        assert(called[-1] is f)
+        assert('ZeroDivisionError' in sys.stderr.getvalue())
+    finally:
+        sys.stderr = stderr
+
+    # Thread and process pools, with buffer arguments and with work
+    # which cannot be sent to a worker process.
+    for processes in (False, True):
+        ex = CryptoExecutor(workers=2, processes=processes)
+        fs = [ex.aencrypt(key, 3, big) for i in xrange(20)]
+        fs = [ex.adecrypt(key, 3, buffer(f.result(5))) for f in fs]
+        assert(all(f.result(5) == big for f in fs))
+        ctext = crypto.encrypt(key, 3, big)
+        assert(ex.adecrypt(key, 3, memoryview(ctext)).result(5) == big)
+        if processes:
+            # A confounder function cannot be pickled.
+            for i in xrange(3):
+                f = ex.aencrypt(key, 3, big, lambda: None)
+                try:
+                    f.result(5)
+                    assert(False)
+                except ResultTimeout:
+                    assert(False)
+                except Exception:
+                    pass
+            assert(ex.aencrypt(key, 3, big).result(5))
+        ex.close()
@@ -0,0 +1,113 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module has minimal DER encoding and decoding helpers for code
+# which works on encoded messages directly instead of going through
+# pyasn1.  Only low tag numbers (below 31) are supported.  Data to be
+# read may be a string or a buffer object; tags are single bytes.
+
+
+def encode_length(n):
+    if n < 0x80:
+        return chr(n)
+    s = ''
+    while n:
+        s = chr(n & 0xff) + s
+        n >>= 8
+    return chr(0x80 | len(s)) + s
+
+
+def encode_integer(n):
+    # Return the contents of a DER INTEGER.
+    s = chr(n & 0xff)
+    n >>= 8
+    while n not in (0, -1) or (n == 0) != (ord(s[0]) < 0x80):
+        s = chr(n & 0xff) + s
+        n >>= 8
+    return s
+
+
+def encode_tlv(tag, contents):
+    return chr(tag) + encode_length(len(contents)) + contents
+
+
+def read_header(data, off, end):
+    # Return the tag, contents start and contents end of the DER value
+    # at off.  Raise ValueError if it does not fit before end.
+    if end - off < 2:
+        raise ValueError('Truncated DER value')
+    tag = ord(data[off])
+    if tag & 0x1f == 0x1f:
+        raise ValueError('Unsupported DER tag')
+    n = ord(data[off + 1])
+    off += 2
+    if n & 0x80:
+        nbytes = n & 0x7f
+        if nbytes == 0 or nbytes > 4 or end - off < nbytes:
+            raise ValueError('Invalid DER length')
+        n = 0
+        for i in xrange(nbytes):
+            n = (n << 8) | ord(data[off + i])
+        off += nbytes
+    if n > end - off:
+        raise ValueError('Truncated DER value')
+    return tag, off, off + n
+
+
+def read_integer(data, off, end):
+    # Return the value of the DER INTEGER at off.
+    tag, start, end = read_header(data, off, end)
+    if tag != 0x02 or start == end:
+        raise ValueError('Expected DER INTEGER')
+    n = 0
+    for i in xrange(start, end):
+        n = (n << 8) | ord(data[i])
+    if ord(data[start]) & 0x80:
+        n -= 1 << (8 * (end - start))
+    return n
+
+
+if __name__ == '__main__':
+    from pyasn1.codec.der import encoder
+    from pyasn1.type.univ import Integer, OctetString
+
+    for n in (0, 1, 127, 128, 255, 256, -1, -128, -129, 2 ** 31, -2 ** 31):
+        der = encoder.encode(Integer(n))
+        assert(encode_tlv(0x02, encode_integer(n)) == der)
+        assert(read_integer(der, 0, len(der)) == n)
+    for n in (0, 127, 128, 255, 256, 65536, 2 ** 24):
+        der = encoder.encode(OctetString('x' * n))
+        assert(encode_tlv(0x04, 'x' * n) == der)
+        assert(read_header(der, 0, len(der)) == (0x04, len(der) - n, len(der)))
+    for bad in ('', '\x04', '\x04\x02x', '\x1f\x00', '\x04\x80',
+                '\x04\x85\x00\x00\x00\x00\x00'):
+        try:
+            read_header(bad, 0, len(bad))
+            assert(False)
+        except ValueError:
+            pass
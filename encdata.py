@@ -0,0 +1,204 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module encrypts directly to the DER encoding of an
+# EncryptedData, and decrypts from the DER encoding of an
+# EncryptedData (or a message containing one), without building
+# pyasn1 objects around the ciphertext.  Going through pyasn1 copies
+# the ciphertext once per level of encoding; here it is copied once,
+# when the encoding is assembled.  Decryption reads the ciphertext
+# through a buffer object over the input, so it is not copied before
+# the cipher sees it.
+#
+# Input may be a string, a bytearray or a memoryview (which is copied
+# once, since the crypto backends do not accept memoryviews under
+# Python 2).
+
+import asn1
+import crypto
+from der import encode_integer, encode_length, encode_tlv
+from der import read_header, read_integer
+
+
+def _as_buffer(data):
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    if not isinstance(data, str):
+        return buffer(data)
+    return data
+
+
+def _parts(enctype, kvno, ctext):
+    # Return the pieces of an EncryptedData contents encoding, with
+    # the ciphertext last.
+    fields = encode_tlv(0xa0, encode_tlv(0x02, encode_integer(enctype)))
+    if kvno is not None:
+        fields += encode_tlv(0xa1, encode_tlv(0x02, encode_integer(kvno)))
+    octets = '\x04' + encode_length(len(ctext))
+    field = '\xa2' + encode_length(len(octets) + len(ctext))
+    return [fields, field, octets, ctext]
+
+
+def encode(key, keyusage, plaintext, kvno=None, confounder=None):
+    # Encrypt plaintext and return the DER encoding of an
+    # EncryptedData holding the result.
+    parts = _parts(key.enctype, kvno, crypto.encrypt(key, keyusage,
+                                                     plaintext, confounder))
+    length = sum(len(p) for p in parts)
+    return ''.join(['\x30' + encode_length(length)] + parts)
+
+
+def encrypt(key, keyusage, plaintext, kvno=None, confounder=None):
+    # Encrypt plaintext and return a frozen asn1.EncryptedData holding
+    # the result, ready to be assigned into a Ticket or reply.  Its
+    # encoding is assembled here rather than by pyasn1.
+    ctext = crypto.encrypt(key, keyusage, plaintext, confounder)
+    value = asn1.EncryptedData()
+    value['etype'] = key.enctype
+    if kvno is not None:
+        value['kvno'] = kvno
+    value['cipher'] = ctext
+    return value.freeze(''.join(_parts(key.enctype, kvno, ctext)))
+
+
+def find(data, tagnum):
+    # Return the offset within data of the value of context field
+    # tagnum of the SEQUENCE (which may have an application tag) at
+    # the start of data, such as 3 for the enc-part of a Ticket or 6
+    # for the enc-part of a KDC-REP.
+    data = _as_buffer(data)
+    tag, start, end = read_header(data, 0, len(data))
+    if tag & 0xe0 == 0x60:
+        tag, start, end = read_header(data, start, end)
+    if tag != 0x30:
+        raise ValueError('Expected DER SEQUENCE')
+    off = start
+    while off < end:
+        tag, vstart, vend = read_header(data, off, end)
+        if tag == 0xa0 | tagnum:
+            return vstart
+        off = vend
+    raise ValueError('Field %d not found' % tagnum)
+
+
+def parse(data, offset=0):
+    # Return (etype, kvno, cipher) for the EncryptedData encoding at
+    # offset within data.  kvno is None if absent; cipher is a buffer
+    # object over data.
+    data = _as_buffer(data)
+    tag, start, end = read_header(data, offset, len(data))
+    if tag != 0x30:
+        raise ValueError('Expected DER SEQUENCE')
+    tag, fstart, off = read_header(data, start, end)
+    if tag != 0xa0:
+        raise ValueError('Missing EncryptedData etype')
+    etype = read_integer(data, fstart, off)
+    kvno = None
+    tag, fstart, fend = read_header(data, off, end)
+    if tag == 0xa1:
+        kvno = read_integer(data, fstart, fend)
+        tag, fstart, fend = read_header(data, fend, end)
+    if tag != 0xa2 or fend != end:
+        raise ValueError('Malformed EncryptedData')
+    tag, cstart, cend = read_header(data, fstart, fend)
+    if tag != 0x04 or cend != fend:
+        raise ValueError('Malformed EncryptedData cipher')
+    return etype, kvno, buffer(data, cstart, cend - cstart)
+
+
+def decrypt(key, keyusage, data, tagnum=None):
+    # Decrypt the EncryptedData encoded in data, or in context field
+    # tagnum of the message in data.  Raise ValueError if the encoding
+    # is malformed or its etype does not match key, and
+    # crypto.InvalidChecksum on integrity failure.
+    data = _as_buffer(data)
+    offset = 0 if tagnum is None else find(data, tagnum)
+    etype, kvno, cipher = parse(data, offset)
+    if etype != key.enctype:
+        raise ValueError('EncryptedData etype %d does not match key' % etype)
+    return crypto.decrypt(key, keyusage, cipher)
+
+
+if __name__ == '__main__':
+    from pyasn1.codec.der import decoder, encoder
+
+    def pyasn1_encode(enctype, kvno, ctext):
+        ed = asn1.EncryptedData()
+        ed['etype'] = enctype
+        if kvno is not None:
+            ed['kvno'] = kvno
+        ed['cipher'] = ctext
+        return encoder.encode(ed)
+
+    key = crypto.Key(crypto.Enctype.AES128, '\x01' * 16)
+    conf = '\x02' * 16
+    for kvno in (None, 0, 3, 300):
+        for size in (0, 100, 1000, 70000):
+            ptext = 'x' * size
+            der = encode(key, 7, ptext, kvno, conf)
+            ctext = crypto.encrypt(key, 7, ptext, conf)
+            assert(der == pyasn1_encode(key.enctype, kvno, ctext))
+            assert(encoder.encode(encrypt(key, 7, ptext, kvno, conf)) == der)
+            assert(parse(der)[:2] == (key.enctype, kvno))
+            assert(str(parse(der)[2]) == ctext)
+            for form in (der, bytearray(der), memoryview(der)):
+                assert(decrypt(key, 7, form) == ptext)
+
+    # Decryption from within a Ticket, and embedding in one.
+    ticket = asn1.Ticket()
+    ticket['tkt-vno'] = 5
+    ticket['realm'] = 'R'
+    ticket['sname'] = None
+    ticket['sname']['name-type'] = 2
+    ticket['sname']['name-string'] = None
+    ticket['sname']['name-string'][0] = 'krbtgt'
+    ticket['enc-part'] = encrypt(key, 2, 'ticket contents', 1)
+    der = encoder.encode(ticket)
+    assert(decrypt(key, 2, der, 3) == 'ticket contents')
+    t = decoder.decode(der, asn1Spec=asn1.Ticket())[0]
+    assert(crypto.decrypt(key, 2, str(t['enc-part']['cipher'])) ==
+           'ticket contents')
+
+    # Errors.
+    try:
+        decrypt(crypto.Key(crypto.Enctype.AES256, '\x01' * 32), 2, der, 3)
+        assert(False)
+    except ValueError:
+        pass
+    try:
+        decrypt(key, 3, der, 3)
+        assert(False)
+    except crypto.InvalidChecksum:
+        pass
+    for bad in ('', '\x30', '\x30\x05\xa0\x03\x02\x01', der[:-1],
+                '\x30\x00', '\x31\x00'):
+        try:
+            decrypt(key, 2, bad)
+            assert(False)
+        except ValueError:
+            pass
@@ -0,0 +1,325 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module implements the RFC 4121 per-message tokens (MIC and
+# wrap tokens) for an established krb5 GSS-API security context.
+# Context establishment is not handled here; the caller supplies the
+# context key and initial sequence numbers.
+
+from struct import pack, unpack
+import crypto
+from crypto import Cksumtype, Enctype
+
+
+TOK_MIC = '\x04\x04'
+TOK_WRAP = '\x05\x04'
+
+FLAG_SENT_BY_ACCEPTOR = 0x01
+FLAG_SEALED = 0x02
+FLAG_ACCEPTOR_SUBKEY = 0x04
+
+# RFC 4121 section 2 key usage numbers.
+KU_ACCEPTOR_SEAL = 22
+KU_ACCEPTOR_SIGN = 23
+KU_INITIATOR_SEAL = 24
+KU_INITIATOR_SIGN = 25
+
+
+class GSSError(ValueError):
+    pass
+
+
+class DuplicateToken(GSSError):
+    pass
+
+
+class OldToken(GSSError):
+    pass
+
+
+_required_cksumtype = {
+    Enctype.DES3: Cksumtype.SHA1_DES3,
+    Enctype.AES128: Cksumtype.SHA1_AES128,
+    Enctype.AES256: Cksumtype.SHA1_AES256,
+    Enctype.RC4: Cksumtype.HMAC_MD5
+}
+
+
+class _ReplayWindow(object):
+    # Track received sequence numbers in a bitmap of the last size
+    # numbers below the highest one seen.  Bit i of bits is set if
+    # high - i has been received.  Numbers below first, the initial
+    # sequence number, are never accepted.
+    def __init__(self, first, size):
+        self.size = size
+        self.first = first
+        self.high = first - 1
+        self.bits = 0
+
+    def check(self, seq):
+        if seq < self.first:
+            raise OldToken('Token sequence number is too old')
+        if seq > self.high:
+            shift = seq - self.high
+            self.bits = ((self.bits << shift) | 1) & ((1 << self.size) - 1)
+            self.high = seq
+            return
+        offset = self.high - seq
+        if offset >= self.size:
+            raise OldToken('Token sequence number is too old')
+        if self.bits & (1 << offset):
+            raise DuplicateToken('Token has already been received')
+        self.bits |= 1 << offset
+
+
+class GSSContext(object):
+    # key is the crypto.Key for the context (the acceptor subkey if
+    # acceptor_subkey is set).  initiator is True for the side which
+    # initiated the context.  send_seq and recv_seq are the initial
+    # sequence numbers for each direction.  Tokens up to window
+    # positions behind the newest received token are accepted once;
+    # older ones and duplicates are rejected.
+    def __init__(self, key, initiator, send_seq=0, recv_seq=0,
+                 acceptor_subkey=False, window=64):
+        self.key = key
+        self.initiator = initiator
+        self.cksumtype = _required_cksumtype[key.enctype]
+        self.cksumsize = crypto._get_checksum_profile(self.cksumtype).macsize
+        self.padsize = getattr(crypto._get_enctype_profile(key.enctype),
+                               'padsize', 1)
+        self.send_seq = send_seq
+        self._window = _ReplayWindow(recv_seq, window)
+        if initiator:
+            send_seal, send_sign = KU_INITIATOR_SEAL, KU_INITIATOR_SIGN
+            recv_seal, recv_sign = KU_ACCEPTOR_SEAL, KU_ACCEPTOR_SIGN
+        else:
+            send_seal, send_sign = KU_ACCEPTOR_SEAL, KU_ACCEPTOR_SIGN
+            recv_seal, recv_sign = KU_INITIATOR_SEAL, KU_INITIATOR_SIGN
+        self._send_seal = crypto.DerivedKeys(key, send_seal)
+        self._send_sign = crypto.DerivedKeys(key, send_sign)
+        self._recv_seal = crypto.DerivedKeys(key, recv_seal)
+        self._recv_sign = crypto.DerivedKeys(key, recv_sign)
+        self._send_flags = 0 if initiator else FLAG_SENT_BY_ACCEPTOR
+        self._recv_flags = FLAG_SENT_BY_ACCEPTOR if initiator else 0
+        if acceptor_subkey:
+            self._send_flags |= FLAG_ACCEPTOR_SUBKEY
+            self._recv_flags |= FLAG_ACCEPTOR_SUBKEY
+
+    def _next_seq(self):
+        seq = self.send_seq
+        self.send_seq = (seq + 1) & 0xffffffffffffffff
+        return seq
+
+    def _check_flags(self, flags, sealed):
+        mask = FLAG_SENT_BY_ACCEPTOR | FLAG_ACCEPTOR_SUBKEY
+        if flags & mask != self._recv_flags:
+            raise GSSError('Unexpected token flags')
+        if sealed is not None and bool(flags & FLAG_SEALED) != sealed:
+            raise GSSError('Unexpected token flags')
+
+    def get_mic(self, message):
+        header = pack('>2sB5sQ', TOK_MIC, self._send_flags, '\xff' * 5,
+                      self._next_seq())
+        return header + self._send_sign.checksum(self.cksumtype,
+                                                 message + header)
+
+    def verify_mic(self, message, token):
+        # Throw crypto.InvalidChecksum on checksum failure, and
+        # GSSError (or a subclass) on a malformed or replayed token.
+        if len(token) != 16 + self.cksumsize:
+            raise GSSError('MIC token has the wrong length')
+        tokid, flags, filler, seq = unpack('>2sB5sQ', token[:16])
+        if tokid != TOK_MIC or filler != '\xff' * 5:
+            raise GSSError('Invalid MIC token header')
+        self._check_flags(flags, False)
+        self._recv_sign.verify(self.cksumtype, message + token[:16],
+                               token[16:])
+        self._window.check(seq)
+
+    def wrap(self, message, seal=True):
+        seq = self._next_seq()
+        if seal:
+            # Add filler so that no further padding is needed by the
+            # enctype, which would be indistinguishable from data.
+            ec = -(len(message) + 16) % self.padsize
+            header = pack('>2sBBHHQ', TOK_WRAP,
+                          self._send_flags | FLAG_SEALED, 0xff, ec, 0, seq)
+            ctext = self._send_seal.encrypt(message + '\0' * ec + header)
+            return header + ctext
+        header = pack('>2sBBHHQ', TOK_WRAP, self._send_flags, 0xff, 0, 0,
+                      seq)
+        cksum = self._send_sign.checksum(self.cksumtype, message + header)
+        header = header[:4] + pack('>H', len(cksum)) + header[6:]
+        return header + message + cksum
+
+    def unwrap(self, token):
+        # Return the message contained in a wrap token.  Throw
+        # crypto.InvalidChecksum on integrity failure, and GSSError (or
+        # a subclass) on a malformed or replayed token.
+        if len(token) < 16:
+            raise GSSError('Wrap token too short')
+        tokid, flags, filler, ec, rrc, seq = unpack('>2sBBHHQ', token[:16])
+        if tokid != TOK_WRAP or filler != 0xff:
+            raise GSSError('Invalid wrap token header')
+        self._check_flags(flags, None)
+        data = token[16:]
+        if rrc and data:
+            rrc %= len(data)
+            data = data[rrc:] + data[:rrc]
+        if flags & FLAG_SEALED:
+            ptext = self._recv_seal.decrypt(data)
+            if len(ptext) < ec + 16:
+                raise GSSError('Wrap token too short')
+            inner = ptext[-16:]
+            if inner[:6] != token[:6] or inner[8:] != token[8:16]:
+                raise GSSError('Wrap token header mismatch')
+            message = ptext[:-16-ec]
+        else:
+            # EC holds the checksum length in an unsealed token.
+            if ec != self.cksumsize or ec > len(data):
+                raise GSSError('Wrap token has a bad checksum length')
+            message, cksum = data[:len(data)-ec], data[len(data)-ec:]
+            header = token[:4] + '\0\0\0\0' + token[8:16]
+            self._recv_sign.verify(self.cksumtype, message + header, cksum)
+        self._window.check(seq)
+        return message
+
+    def wrap_stream(self, data, chunksize=65536, seal=True):
+        # Generate wrap tokens for successive chunks of data, which
+        # may be a string or a file-like object.
+        if hasattr(data, 'read'):
+            while True:
+                chunk = data.read(chunksize)
+                if not chunk:
+                    return
+                yield self.wrap(chunk, seal)
+        else:
+            view = buffer(data)
+            for off in xrange(0, len(view), chunksize):
+                yield self.wrap(str(view[off:off+chunksize]), seal)
+
+    def unwrap_stream(self, tokens):
+        # Generate the messages contained in an iterable of wrap
+        # tokens.
+        for token in tokens:
+            yield self.unwrap(token)
+
+
+if __name__ == '__main__':
+    def h(hexstr):
+        return hexstr.decode('hex')
+
+    aes128 = crypto.Key(Enctype.AES128, h('9062430C8CDA3388922E6D6A509F5B7A'))
+    des3 = crypto.Key(Enctype.DES3, h('0DD52094E0F41CECCB5BE510A764B351'
+                                      '76E3981332F1E598'))
+    for k in (aes128, des3):
+        ini = GSSContext(k, True, send_seq=100, recv_seq=200)
+        acc = GSSContext(k, False, send_seq=200, recv_seq=100)
+
+        # Round trips in both directions, sealed and unsealed.
+        for msg in ('', 'x', '13 bytes byte', 'z' * 1000):
+            assert(acc.unwrap(ini.wrap(msg)) == msg)
+            assert(acc.unwrap(ini.wrap(msg, seal=False)) == msg)
+            assert(ini.unwrap(acc.wrap(msg)) == msg)
+            acc.verify_mic(msg, ini.get_mic(msg))
+            ini.verify_mic(msg, acc.get_mic(msg))
+
+        # A token is rejected by its sender and cannot be replayed.
+        tok = ini.wrap('hello')
+        try:
+            ini.unwrap(tok)
+            assert(False)
+        except GSSError:
+            pass
+        assert(acc.unwrap(tok) == 'hello')
+        try:
+            acc.unwrap(tok)
+            assert(False)
+        except DuplicateToken:
+            pass
+
+        # Tokens numbered below the initial sequence number are
+        # rejected.
+        early = GSSContext(k, True, send_seq=50)
+        fresh = GSSContext(k, False, recv_seq=100)
+        try:
+            fresh.unwrap(early.wrap('early'))
+            assert(False)
+        except OldToken:
+            pass
+        assert(GSSContext(k, False, recv_seq=50).unwrap(
+            early.wrap('early')) == 'early')
+
+        # Tokens whose checksums are truncated are rejected.
+        try:
+            acc.verify_mic('forged', ini.get_mic('m')[:16])
+            assert(False)
+        except GSSError:
+            pass
+        tok = ini.wrap('forged', seal=False)
+        tok = tok[:4] + pack('>H', 0) + tok[6:16] + 'forged'
+        try:
+            acc.unwrap(tok)
+            assert(False)
+        except GSSError:
+            pass
+
+        # Out-of-order tokens within the window are accepted.
+        t1, t2 = ini.wrap('one'), ini.wrap('two')
+        assert(acc.unwrap(t2) == 'two' and acc.unwrap(t1) == 'one')
+        mics = [ini.get_mic('m') for i in xrange(70)]
+        acc.verify_mic('m', mics[-1])
+        try:
+            acc.verify_mic('m', mics[0])
+            assert(False)
+        except OldToken:
+            pass
+
+        # Tampering is detected.
+        for seal in (True, False):
+            tok = ini.wrap('tamper', seal)
+            tok = tok[:-1] + chr(ord(tok[-1]) ^ 1)
+            try:
+                acc.unwrap(tok)
+                assert(False)
+            except crypto.InvalidChecksum:
+                pass
+
+        # Tokens rotated by the sender (RRC) are accepted.
+        tok = ini.wrap('rotated message')
+        rrc = 28
+        body = tok[16:]
+        tok = (tok[:6] + pack('>H', rrc) + tok[8:16] +
+               body[-rrc:] + body[:-rrc])
+        assert(acc.unwrap(tok) == 'rotated message')
+
+        # Streams are split into tokens and reassembled.
+        data = ''.join(chr(i % 256) for i in xrange(100000))
+        tokens = list(ini.wrap_stream(data, chunksize=4096))
+        assert(len(tokens) == 25)
+        assert(''.join(acc.unwrap_stream(tokens)) == data)
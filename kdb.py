@@ -0,0 +1,455 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module holds an in-memory principal database for a stand-in
+# KDC or a test harness.  Databases are loaded from a dump file with
+# one principal per line, holding tab-separated fields:
+#
+#   name  attributes  max_life  max_renew  expiration  keys
+#
+# name is a principal string as produced by principal.unparse().
+# attributes is a bitmask of Attr flags, max_life and max_renew are
+# in seconds, and expiration is a time in seconds since the epoch, or
+# 0 for none.  keys is a space-separated list of key entries of the
+# form kvno:enctype:key[:salt], with the key and salt in hex; a key
+# with no salt uses the default salt (the realm followed by the name
+# components).  Blank lines and lines starting with '#' are ignored.
+#
+# Each principal is kept as the unparsed remainder of its dump line,
+# indexed by name and by realm, so that loading does no per-field
+# work.  get() parses a record into an Entry, and each key's
+# crypto.Key object is only created when it is first used.  Because
+# the tables hold only strings, the garbage collector never walks
+# them, and worker processes forked after loading share the parent's
+# pages.  Recently returned entries are cached, so the principals
+# named in most requests (such as krbtgt) are parsed once; entries
+# are shared between callers and must not be modified, but may be
+# replaced with put().  snapshot() returns a read-only view of the
+# database as it is; the next write copies the tables rather than
+# changing them under the snapshot.
+
+import threading
+import asn1
+import crypto
+import principal
+
+
+MAX_CACHED = 4096
+
+# MIT krb5 principal attribute flags.
+class Attr(object):
+    DISALLOW_POSTDATED = 0x1
+    DISALLOW_FORWARDABLE = 0x2
+    DISALLOW_TGT_BASED = 0x4
+    DISALLOW_RENEWABLE = 0x8
+    DISALLOW_PROXIABLE = 0x10
+    DISALLOW_DUP_SKEY = 0x20
+    DISALLOW_ALL_TIX = 0x40
+    REQUIRES_PRE_AUTH = 0x80
+    REQUIRES_HW_AUTH = 0x100
+    REQUIRES_PWCHANGE = 0x200
+    DISALLOW_SVR = 0x1000
+    PWCHANGE_SERVICE = 0x2000
+    OK_AS_DELEGATE = 0x100000
+    OK_TO_AUTH_AS_DELEGATE = 0x200000
+    NO_AUTH_DATA_REQUIRED = 0x400000
+
+
+class DumpError(ValueError):
+    pass
+
+
+class KeyData(object):
+    # A principal key.  salt is None for the default salt.
+    __slots__ = ('kvno', 'enctype', 'contents', 'salt', '_key')
+
+    def __init__(self, kvno, enctype, contents, salt=None):
+        self.kvno = kvno
+        self.enctype = enctype
+        self.contents = contents
+        self.salt = salt
+        self._key = None
+
+    @property
+    def key(self):
+        if self._key is None:
+            self._key = crypto.intern_key(crypto.Key(self.enctype,
+                                                     self.contents))
+        return self._key
+
+    def __str__(self):
+        s = '%d:%d:%s' % (self.kvno, self.enctype,
+                          self.contents.encode('hex'))
+        return s if self.salt is None else s + ':' + self.salt.encode('hex')
+
+
+def _parse_keys(field):
+    keys = []
+    for item in field.split():
+        parts = item.split(':')
+        if len(parts) not in (3, 4):
+            raise DumpError('Malformed key entry %r' % item)
+        try:
+            salt = parts[3].decode('hex') if len(parts) == 4 else None
+            keys.append(KeyData(int(parts[0]), int(parts[1]),
+                                parts[2].decode('hex'), salt))
+        except (TypeError, ValueError):
+            raise DumpError('Malformed key entry %r' % item)
+    return keys
+
+
+class Entry(object):
+    # A principal entry, as returned by get().  keys lists KeyData
+    # objects in dump order.
+    __slots__ = ('name', 'attributes', 'max_life', 'max_renew',
+                 'expiration', '_keyfield', '_keys')
+
+    def __init__(self, name, attributes=0, max_life=86400,
+                 max_renew=604800, expiration=0, keys=()):
+        self.name = name
+        self.attributes = attributes
+        self.max_life = max_life
+        self.max_renew = max_renew
+        self.expiration = expiration
+        self._keyfield = None
+        self._keys = list(keys)
+
+    @property
+    def keys(self):
+        if self._keys is None:
+            self._keys = _parse_keys(self._keyfield)
+        return self._keys
+
+    @property
+    def principal(self):
+        return principal.parse(self.name)
+
+    @property
+    def kvno(self):
+        # The highest key version number, or 0 if there are no keys.
+        return max([k.kvno for k in self.keys] or [0])
+
+    def key_data(self, enctype, kvno=None):
+        # Return the KeyData for enctype with the given version, or the
+        # highest version if kvno is None, or None if there is none.
+        best = None
+        for k in self.keys:
+            if k.enctype != enctype:
+                continue
+            if kvno is None:
+                if best is None or k.kvno > best.kvno:
+                    best = k
+            elif k.kvno == kvno:
+                return k
+        return best
+
+    def key(self, enctype, kvno=None):
+        # Return a crypto.Key as for key_data(), or None.
+        k = self.key_data(enctype, kvno)
+        return None if k is None else k.key
+
+    def salt(self, enctype, kvno=None):
+        # Return the string-to-key salt for a key, or None if there is
+        # no such key.
+        k = self.key_data(enctype, kvno)
+        if k is None:
+            return None
+        if k.salt is not None:
+            return k.salt
+        p = self.principal
+        return p.realm + ''.join(p.components)
+
+    def etype_info2(self, enctypes):
+        # Return an asn1.ETypeInfo2 describing the principal's current
+        # keys for each of enctypes (in the client's preference order)
+        # which it has.
+        info = asn1.ETypeInfo2()
+        i = 0
+        for enctype in enctypes:
+            salt = self.salt(enctype)
+            if salt is None:
+                continue
+            e = asn1.ETypeInfo2Entry()
+            e['etype'] = enctype
+            e['salt'] = salt
+            info[i] = e
+            i += 1
+        return info
+
+    def record(self):
+        # Return the dump fields following the name.
+        keys = (self._keyfield if self._keys is None
+                else ' '.join(str(k) for k in self._keys))
+        return '%d\t%d\t%d\t%d\t%s' % (self.attributes, self.max_life,
+                                       self.max_renew, self.expiration, keys)
+
+
+def _parse_record(name, record):
+    fields = record.split('\t')
+    try:
+        attrs, life, renew, exp = [int(f) for f in fields[:4]]
+    except ValueError:
+        raise DumpError('Malformed record for %s' % name)
+    e = Entry(name, attrs, life, renew, exp)
+    e._keyfield = fields[4]
+    e._keys = None
+    return e
+
+
+def _realm(name):
+    if '\\' in name:
+        return principal.parse(name).realm
+    return name[name.rindex('@')+1:]
+
+
+def _name(p):
+    return p if isinstance(p, str) else str(p)
+
+
+class _Reader(object):
+    # Lookups shared by databases and snapshots.  _records maps names
+    # to records, and _realms maps realms to lists of names.
+    def __init__(self, records, realms):
+        self._records = records
+        self._realms = realms
+        self._cache = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, name):
+        return _name(name) in self._records
+
+    def __iter__(self):
+        return iter(list(self._records))
+
+    def get(self, name):
+        # Return an Entry for name (a string or principal.Principal), or
+        # None if there is no such principal.
+        name = _name(name)
+        entry = self._cache.get(name)
+        if entry is not None:
+            return entry
+        record = self._records.get(name)
+        if record is None:
+            return None
+        entry = _parse_record(name, record)
+        cache = self._cache
+        if len(cache) >= MAX_CACHED:
+            cache.clear()
+        cache[name] = entry
+        if self._records.get(name) is not record:
+            # A concurrent write replaced the record.
+            cache.pop(name, None)
+        return entry
+
+    def realms(self):
+        return list(self._realms)
+
+    def principals(self, realm):
+        # Return the names of the principals in realm, in load order.
+        return list(self._realms.get(realm, ()))
+
+    def dump(self, f):
+        records = self._records
+        for realm, names in self._realms.items():
+            for name in names:
+                f.write('%s\t%s\n' % (name, records[name]))
+
+
+class Snapshot(_Reader):
+    pass
+
+
+class Database(_Reader):
+    def __init__(self):
+        _Reader.__init__(self, {}, {})
+        self._lock = threading.Lock()
+        self._shared = False
+
+    def _own(self):
+        # Copy the tables if a snapshot shares them.
+        if self._shared:
+            self._records = dict(self._records)
+            self._realms = dict((realm, list(names)) for realm, names
+                                in self._realms.iteritems())
+            self._shared = False
+
+    def load(self, f):
+        # Add the principals in an open dump file (or any iterable of
+        # lines), replacing existing entries with the same names.
+        # Return the number of principals read.
+        with self._lock:
+            self._own()
+            records = self._records
+            realms = self._realms
+            count = 0
+            for lineno, line in enumerate(f, 1):
+                if not line.strip() or line[0] == '#':
+                    continue
+                name, sep, record = line.rstrip('\r\n').partition('\t')
+                if record.count('\t') != 4 or '@' not in name:
+                    raise DumpError('Malformed dump line %d' % lineno)
+                n = len(records)
+                records[name] = record
+                if len(records) != n:
+                    realm = _realm(name)
+                    names = realms.get(realm)
+                    if names is None:
+                        names = realms[realm] = []
+                    names.append(name)
+                count += 1
+            self._cache.clear()
+            return count
+
+    def put(self, entry):
+        # Add or replace an Entry.
+        name = _name(entry.name)
+        record = entry.record()
+        with self._lock:
+            self._own()
+            if name not in self._records:
+                self._realms.setdefault(_realm(name), []).append(name)
+            self._records[name] = record
+            self._cache.pop(name, None)
+
+    def remove(self, name):
+        name = _name(name)
+        with self._lock:
+            if name not in self._records:
+                return
+            self._own()
+            del self._records[name]
+            self._cache.pop(name, None)
+            realm = _realm(name)
+            names = self._realms[realm]
+            names.remove(name)
+            if not names:
+                del self._realms[realm]
+
+    def snapshot(self):
+        with self._lock:
+            self._shared = True
+            return Snapshot(self._records, self._realms)
+
+
+def load(f):
+    # Return a Database loaded from a dump file name or open file.
+    db = Database()
+    if isinstance(f, basestring):
+        with open(f) as fobj:
+            db.load(fobj)
+    else:
+        db.load(f)
+    return db
+
+
+if __name__ == '__main__':
+    import gc
+    from StringIO import StringIO
+    from crypto import Enctype
+
+    aeskey = '\x11' * 32
+    dump = StringIO('# test database\n'
+                    '\n'
+                    'krbtgt/KRBTEST.COM@KRBTEST.COM\t0\t36000\t0\t0\t'
+                    '2:18:%s 1:18:%s\n'
+                    'user@KRBTEST.COM\t128\t36000\t604800\t0\t'
+                    '1:18:%s 1:16:%s:%s\n'
+                    'alice@OTHER.COM\t0\t3600\t0\t2000000000\t\n'
+                    % (aeskey.encode('hex'), ('\x22' * 32).encode('hex'),
+                       aeskey.encode('hex'), ('\x33' * 24).encode('hex'),
+                       'EXAMPLEsalt'.encode('hex')))
+    db = load(dump)
+    assert(len(db) == 3 and 'user@KRBTEST.COM' in db)
+    assert(sorted(db.realms()) == ['KRBTEST.COM', 'OTHER.COM'])
+    assert(db.principals('KRBTEST.COM') ==
+           ['krbtgt/KRBTEST.COM@KRBTEST.COM', 'user@KRBTEST.COM'])
+    assert(db.principals('NONE.COM') == [])
+    assert(not gc.is_tracked(db._records))
+
+    # Lookups by string or Principal; keys are built on first use.
+    tgt = db.get(principal.parse('krbtgt/KRBTEST.COM@KRBTEST.COM'))
+    assert(tgt.max_life == 36000 and tgt._keys is None)
+    assert(tgt.kvno == 2)
+    assert(tgt.key(Enctype.AES256) == crypto.Key(Enctype.AES256, aeskey))
+    assert(tgt.key(Enctype.AES256, 1).contents == '\x22' * 32)
+    assert(tgt.key(Enctype.AES256, 3) is None)
+    assert(tgt.key(Enctype.AES128) is None)
+    assert(db.get('nobody@KRBTEST.COM') is None)
+    user = db.get('user@KRBTEST.COM')
+    assert(user.attributes & Attr.REQUIRES_PRE_AUTH)
+    assert(user.key(Enctype.AES256) is tgt.key(Enctype.AES256))
+    assert(user.salt(Enctype.AES256) == 'KRBTEST.COMuser')
+    assert(user.salt(Enctype.DES3) == 'EXAMPLEsalt')
+    assert(db.get('alice@OTHER.COM').keys == [])
+
+    # ETypeInfo2 follows the client's enctype preference.
+    info = user.etype_info2([Enctype.AES128, Enctype.DES3, Enctype.AES256])
+    assert([int(e['etype']) for e in info] == [Enctype.DES3, Enctype.AES256])
+    assert(str(info[1]['salt']) == 'KRBTEST.COMuser')
+
+    # Snapshots are unaffected by later writes.
+    snap = db.snapshot()
+    e = Entry('host/a.example.com@KRBTEST.COM', max_life=600,
+              keys=[KeyData(5, Enctype.AES256, aeskey)])
+    db.put(e)
+    db.remove('alice@OTHER.COM')
+    assert(len(db) == 3 and len(snap) == 3)
+    assert('alice@OTHER.COM' in snap and 'alice@OTHER.COM' not in db)
+    assert(db.realms() == ['KRBTEST.COM'])
+    assert(len(snap.principals('KRBTEST.COM')) == 2)
+    assert(snap.get(e.name) is None)
+    assert(db.get(e.name).key(Enctype.AES256, 5).contents == aeskey)
+    assert(db.get(e.name).max_life == 600)
+    assert(db.get(e.name) is db.get(e.name))
+    db.put(Entry(e.name, max_life=300))
+    assert(db.get(e.name).max_life == 300 and db.get(e.name).keys == [])
+
+    # Dumps load back to the same database.
+    out = StringIO()
+    db.dump(out)
+    db2 = load(StringIO(out.getvalue()))
+    assert(sorted(db2) == sorted(db))
+    assert(all(db2._records[n] == db._records[n] for n in db))
+
+    # Names with quoted characters are indexed by their realm.
+    db.put(Entry('a\\@b@R\\@S'))
+    assert(db.principals('R@S') == ['a\\@b@R\\@S'])
+
+    for bad in ('user@X\t0\t0\n', 'user\t0\t0\t0\t0\t\n'):
+        try:
+            load(StringIO(bad))
+            assert(False)
+        except DumpError:
+            pass
+    try:
+        load(['u@R\t0\t0\t0\t0\t1:18:zz\n']).get('u@R').keys
+        assert(False)
+    except DumpError:
+        pass
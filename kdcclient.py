@@ -0,0 +1,551 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module sends KDC-REQ messages to one or more KDCs and collects
+# the replies.  Many exchanges can be run at once from a single
+# thread: requests go out over UDP when they are small enough, and
+# over a pool of persistent TCP connections otherwise, with several
+# record-marked requests pipelined on each connection.  A KRB-ERROR
+# with code KRB_ERR_RESPONSE_TOO_BIG on UDP causes a retry over TCP to
+# the same KDC; a timeout or connection failure causes a retry at the
+# next KDC in the list.
+#
+# The nonce of a KDC-REP is only present in the encrypted part, so
+# replies cannot be matched to requests by nonce on the wire.  UDP
+# replies are matched by socket and TCP replies by their position on
+# the connection (KDCs answer pipelined requests in order).  Nonces
+# are used to key the set of outstanding requests; callers should
+# still check the nonce after decrypting the reply.
+
+import errno
+import select
+import socket
+import time
+from collections import deque
+from struct import pack
+from pyasn1.codec.der import decoder, encoder
+import asn1
+from recmark import RecordDecoder, RecordTooLarge
+
+
+KRB_ERR_RESPONSE_TOO_BIG = 52
+
+# MIT krb5 sends requests larger than this over TCP first.
+UDP_PREFERENCE_LIMIT = 1465
+
+
+class KDCTimeout(IOError):
+    pass
+
+
+class KDCUnreachable(IOError):
+    pass
+
+
+_reply_types = {
+    11: asn1.ASRep,
+    13: asn1.TGSRep,
+    30: asn1.KrbError
+}
+
+
+def decode_reply(data):
+    # Decode a KDC reply according to its application tag.  Raise
+    # ValueError if the message is not an AS-REP, TGS-REP, or
+    # KRB-ERROR.
+    if len(data) == 0 or ord(data[0]) & 0xe0 != 0x60:
+        raise ValueError('Reply does not have an application tag')
+    cls = _reply_types.get(ord(data[0]) & 0x1f)
+    if cls is None:
+        raise ValueError('Unexpected reply type %d' % (ord(data[0]) & 0x1f))
+    return decoder.decode(data, asn1Spec=cls())[0]
+
+
+def _is_too_big(reply):
+    return (isinstance(reply, asn1.KrbError) and
+            int(reply['error-code']) == KRB_ERR_RESPONSE_TOO_BIG)
+
+
+class _Request(object):
+    # One outstanding exchange.  kdc is the index of the KDC
+    # currently being tried; sock is set while waiting for a UDP
+    # reply.
+    def __init__(self, index, data, nonce):
+        self.index = index
+        self.data = data
+        self.nonce = nonce
+        self.kdc = 0
+        self.tcp = False
+        self.sock = None
+        self.deadline = None
+        self.retried = False
+
+
+class _ConnectionClosed(socket.error):
+    pass
+
+
+def _closed_by_peer(conn, e):
+    # Return True if the KDC closed conn after answering on it.  A KDC
+    # which closes with requests still unread sends a reset, which
+    # shows up as ECONNRESET or EPIPE rather than EOF.
+    if isinstance(e, _ConnectionClosed):
+        return True
+    return e.errno in (errno.ECONNRESET, errno.EPIPE) and conn.answered > 0
+
+
+class _Connection(object):
+    # A non-blocking TCP connection to one KDC.  Requests written to
+    # the connection are queued in pending and answered in order.
+    # answered counts the replies received on it.
+    def __init__(self, kdc, addr):
+        self.kdc = kdc
+        self.sock = socket.socket(addr[0], socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.connecting = True
+        self.reused = False
+        self.answered = 0
+        self.outbuf = bytearray()
+        self.decoder = RecordDecoder()
+        self.pending = deque()
+        err = self.sock.connect_ex(addr[4])
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.sock.close()
+            raise socket.error(err, errno.errorcode.get(err, 'connect'))
+
+    def send(self, req):
+        self.outbuf += pack('>L', len(req.data))
+        self.outbuf += req.data
+        self.pending.append(req)
+
+    def on_writable(self):
+        if self.connecting:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, errno.errorcode.get(err, 'connect'))
+            self.connecting = False
+        if self.outbuf:
+            n = self.sock.send(self.outbuf)
+            del self.outbuf[:n]
+
+    def on_readable(self):
+        # Return a list of (request, reply data) pairs for each
+        # complete record received.
+        data = self.sock.recv(65536)
+        if not data:
+            raise _ConnectionClosed(errno.ECONNRESET,
+                                    'Connection closed by KDC')
+        try:
+            msgs = self.decoder.feed(data)
+        except RecordTooLarge as e:
+            raise socket.error(errno.EPROTO, str(e))
+        out = []
+        for cls, msg in msgs:
+            if not self.pending:
+                raise socket.error(errno.EPROTO, 'Unsolicited reply')
+            out.append((self.pending.popleft(), msg.tobytes()))
+        self.answered += len(out)
+        return out
+
+    def close(self):
+        self.sock.close()
+
+
+class KDCClient(object):
+    # kdcs is a list of (host, port) pairs, tried in order.  timeout is
+    # the per-KDC timeout for each request in seconds.  Up to
+    # max_conns TCP connections are kept open to each KDC and shared
+    # by later calls; up to max_inflight requests are outstanding at
+    # once.
+    def __init__(self, kdcs, timeout=3.0, udp=True, max_conns=2,
+                 max_inflight=256):
+        if not kdcs:
+            raise ValueError('No KDCs specified')
+        self.kdcs = list(kdcs)
+        self.timeout = timeout
+        self.udp = udp
+        self.max_conns = max_conns
+        self.max_inflight = max_inflight
+        self._addrs = {}
+        self._pool = dict((i, []) for i in xrange(len(self.kdcs)))
+
+    def _addrinfo(self, kdc, socktype):
+        key = (kdc, socktype)
+        if key not in self._addrs:
+            host, port = self.kdcs[kdc]
+            self._addrs[key] = socket.getaddrinfo(host, port, 0, socktype)[0]
+        return self._addrs[key]
+
+    def _get_connection(self, kdc):
+        # Return the least loaded pooled connection to kdc, opening a
+        # new one if the pool is not full.
+        pool = self._pool[kdc]
+        idle = [c for c in pool if not c.pending]
+        if idle:
+            return idle[0]
+        if len(pool) < self.max_conns:
+            conn = _Connection(kdc, self._addrinfo(kdc, socket.SOCK_STREAM))
+            pool.append(conn)
+            return conn
+        return min(pool, key=lambda c: len(c.pending))
+
+    def _drop_connection(self, conn):
+        conn.close()
+        if conn in self._pool[conn.kdc]:
+            self._pool[conn.kdc].remove(conn)
+
+    def _start(self, req):
+        # Send req to its current KDC.
+        req.deadline = time.time() + self.timeout
+        if not req.tcp and self.udp and len(req.data) < UDP_PREFERENCE_LIMIT:
+            addr = self._addrinfo(req.kdc, socket.SOCK_DGRAM)
+            req.sock = socket.socket(addr[0], socket.SOCK_DGRAM)
+            req.sock.setblocking(0)
+            req.sock.connect(addr[4])
+            req.sock.send(req.data)
+        else:
+            req.tcp = True
+            self._get_connection(req.kdc).send(req)
+
+    def _close_udp(self, req):
+        if req.sock is not None:
+            req.sock.close()
+            req.sock = None
+
+    def exchange_many(self, reqs):
+        # Send each KDC-REQ in reqs (a pyasn1 object or its DER
+        # encoding) and return a list of decoded replies in the same
+        # order.  A request which could not be answered by any KDC
+        # has an exception object in its place.
+        results = [None] * len(reqs)
+        queue = deque()
+        nonces = set()
+        for i, r in enumerate(reqs):
+            if isinstance(r, str):
+                data, nonce = r, None
+            else:
+                data, nonce = encoder.encode(r), int(r['req-body']['nonce'])
+            if nonce is not None:
+                if nonce in nonces:
+                    raise ValueError('Duplicate nonce %d' % nonce)
+                nonces.add(nonce)
+            queue.append(_Request(i, data, nonce))
+
+        active = {}
+        for conn in sum(self._pool.values(), []):
+            conn.reused = True
+
+        def finish(req, result):
+            self._close_udp(req)
+            results[req.index] = result
+            active.pop(id(req), None)
+
+        def failover(req, exc):
+            # Retry req at the next KDC, or give up with exc.
+            self._close_udp(req)
+            req.kdc += 1
+            req.tcp = False
+            if req.kdc >= len(self.kdcs):
+                finish(req, exc)
+            else:
+                restart(req)
+
+        def restart(req):
+            try:
+                self._start(req)
+            except socket.error as e:
+                failover(req, KDCUnreachable(str(e)))
+
+        def conn_failed(conn, exc, closed=False):
+            # Move everything waiting on conn elsewhere.  A pooled
+            # connection may simply have been closed while idle, and a
+            # KDC may close a connection after answering some of the
+            # requests on it, so in those cases resend the requests to
+            # the same KDC.  A KDC which closes a fresh connection
+            # without answering gets one more try per request.
+            self._drop_connection(conn)
+            for req in conn.pending:
+                if closed and conn.answered:
+                    restart(req)
+                elif (conn.reused or closed) and not req.retried:
+                    req.retried = True
+                    restart(req)
+                else:
+                    failover(req, exc)
+
+        while queue or active:
+            while queue and len(active) < self.max_inflight:
+                req = queue.popleft()
+                active[id(req)] = req
+                restart(req)
+
+            conns = [c for c in sum(self._pool.values(), [])
+                     if c.pending or c.outbuf]
+            rmap = dict((r.sock.fileno(), r) for r in active.itervalues()
+                        if r.sock is not None)
+            cmap = dict((c.sock.fileno(), c) for c in conns)
+            wfds = [c.sock.fileno() for c in conns
+                    if c.connecting or c.outbuf]
+            now = time.time()
+            deadlines = [r.deadline for r in active.itervalues()]
+            wait = max(0, min(deadlines) - now) if deadlines else 0
+            readable, writable = _wait(rmap.keys() + cmap.keys(), wfds, wait)
+
+            for fd in writable:
+                conn = cmap[fd]
+                try:
+                    conn.on_writable()
+                except socket.error as e:
+                    conn_failed(conn, KDCUnreachable(str(e)),
+                                _closed_by_peer(conn, e))
+
+            for fd in readable:
+                if fd in rmap:
+                    req = rmap[fd]
+                    try:
+                        data = req.sock.recv(65536)
+                        reply = decode_reply(data)
+                    except socket.error as e:
+                        failover(req, KDCUnreachable(str(e)))
+                        continue
+                    except Exception:
+                        # Ignore garbage and keep waiting.
+                        continue
+                    if _is_too_big(reply):
+                        self._close_udp(req)
+                        req.tcp = True
+                        restart(req)
+                    else:
+                        finish(req, reply)
+                elif fd in cmap:
+                    conn = cmap[fd]
+                    if conn not in self._pool[conn.kdc]:
+                        continue
+                    try:
+                        replies = conn.on_readable()
+                    except socket.error as e:
+                        conn_failed(conn, KDCUnreachable(str(e)),
+                                    _closed_by_peer(conn, e))
+                        continue
+                    for req, data in replies:
+                        try:
+                            finish(req, decode_reply(data))
+                        except Exception as e:
+                            finish(req, e)
+
+            # Fail over requests whose deadlines have passed.  Replies
+            # on a TCP connection arrive in order, so a timed-out
+            # connection is dropped along with everything queued on it.
+            now = time.time()
+            for req in active.values():
+                if id(req) not in active or req.deadline > now:
+                    continue
+                exc = KDCTimeout('No reply from %s:%s' % self.kdcs[req.kdc])
+                conns = [c for c in self._pool[req.kdc] if req in c.pending]
+                if req.tcp and conns:
+                    self._drop_connection(conns[0])
+                    for other in conns[0].pending:
+                        failover(other, exc)
+                else:
+                    failover(req, exc)
+
+        return results
+
+    def exchange(self, req):
+        # Send a single KDC-REQ and return the decoded reply, raising
+        # KDCTimeout or KDCUnreachable if no KDC answers.
+        result = self.exchange_many([req])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        for pool in self._pool.itervalues():
+            for conn in pool:
+                conn.close()
+            del pool[:]
+
+
+def _wait(rfds, wfds, timeout):
+    # Wait for file descriptors to become ready and return the
+    # readable and writable sets.  Prefer poll(), which has no limit
+    # on descriptor numbers.
+    if hasattr(select, 'poll'):
+        p = select.poll()
+        flags = {}
+        for fd in rfds:
+            flags[fd] = flags.get(fd, 0) | select.POLLIN
+        for fd in wfds:
+            flags[fd] = flags.get(fd, 0) | select.POLLOUT
+        for fd, f in flags.iteritems():
+            p.register(fd, f)
+        readable, writable = set(), set()
+        for fd, ev in p.poll(timeout * 1000):
+            if ev & (select.POLLIN | select.POLLERR | select.POLLHUP):
+                readable.add(fd)
+            if ev & (select.POLLOUT | select.POLLERR):
+                writable.add(fd)
+        return readable & set(rfds), writable & set(wfds)
+    r, w, x = select.select(rfds, wfds, [], timeout)
+    return r, w
+
+
+if __name__ == '__main__':
+    import threading
+    import recmark
+
+    def krb_error(code):
+        err = asn1.KrbError()
+        err['pvno'] = 5
+        err['msg-type'] = 30
+        err['stime'] = '20130101000000Z'
+        err['susec'] = 0
+        err['error-code'] = code
+        err['realm'] = 'KRBTEST.COM'
+        sname = asn1.PrincipalName()
+        sname['name-type'] = asn1.NameType.SRV_INST
+        sname['name-string'] = None
+        sname['name-string'][0] = 'krbtgt'
+        sname['name-string'][1] = 'KRBTEST.COM'
+        err['sname'] = sname
+        return encoder.encode(err)
+
+    def as_req(nonce):
+        req = asn1.ASReq()
+        req['pvno'] = 5
+        req['msg-type'] = 10
+        req['req-body'] = None
+        body = req['req-body']
+        body['kdc-options'] = "'0'B"
+        body['realm'] = 'KRBTEST.COM'
+        body['till'] = '20370101000000Z'
+        body['nonce'] = nonce
+        body['etype'] = None
+        body['etype'][0] = 18
+        return req
+
+    # A fake KDC which answers every UDP request with
+    # RESPONSE_TOO_BIG and every TCP request with an error code equal
+    # to the request nonce.
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.bind(('127.0.0.1', 0))
+    port = udp.getsockname()[1]
+    tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp.bind(('127.0.0.1', port))
+    tcp.listen(5)
+
+    def serve_udp():
+        while True:
+            data, addr = udp.recvfrom(65536)
+            udp.sendto(krb_error(KRB_ERR_RESPONSE_TOO_BIG), addr)
+
+    def serve_tcp_conn(s):
+        d = RecordDecoder()
+        while True:
+            data = s.recv(65536)
+            if not data:
+                return
+            for cls, msg in d.feed(data):
+                req = recmark.decode(cls, msg)
+                reply = krb_error(int(req['req-body']['nonce']))
+                s.sendall(pack('>L', len(reply)) + reply)
+
+    def serve_tcp():
+        while True:
+            s, addr = tcp.accept()
+            t = threading.Thread(target=serve_tcp_conn, args=(s,))
+            t.daemon = True
+            t.start()
+
+    # A second fake KDC which answers one request per TCP connection
+    # and then closes it.
+    once = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    once.bind(('127.0.0.1', 0))
+    once.listen(5)
+
+    def serve_once():
+        while True:
+            s, addr = once.accept()
+            d = RecordDecoder()
+            msgs = []
+            while not msgs:
+                data = s.recv(65536)
+                if not data:
+                    break
+                msgs = d.feed(data)
+            if msgs:
+                req = recmark.decode(*msgs[0])
+                reply = krb_error(int(req['req-body']['nonce']))
+                s.sendall(pack('>L', len(reply)) + reply)
+            s.close()
+
+    for f in (serve_udp, serve_tcp, serve_once):
+        t = threading.Thread(target=f)
+        t.daemon = True
+        t.start()
+
+    # The first KDC does not exist; requests should fail over to the
+    # second, fall back from UDP to TCP, and be matched up in order.
+    dead = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dead.bind(('127.0.0.1', 0))
+    client = KDCClient([dead.getsockname(), ('127.0.0.1', port)],
+                       timeout=0.5, max_inflight=50)
+    replies = client.exchange_many([as_req(n) for n in xrange(100, 300)])
+    assert([int(r['error-code']) for r in replies] == range(100, 300))
+    assert(int(client.exchange(as_req(7))['error-code']) == 7)
+
+    # A closed port is skipped without waiting for the timeout.
+    closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    closed.bind(('127.0.0.1', 0))
+    closed_addr = closed.getsockname()
+    closed.close()
+    client = KDCClient([closed_addr, ('127.0.0.1', port)], timeout=5)
+    start = time.time()
+    assert(int(client.exchange(as_req(8))['error-code']) == 8)
+    assert(time.time() - start < 2)
+    client = KDCClient([closed_addr], timeout=5)
+    try:
+        client.exchange(as_req(1))
+        assert(False)
+    except KDCUnreachable:
+        pass
+
+    # Requests left unanswered when a KDC closes a connection are
+    # resent to the same KDC.
+    client = KDCClient([once.getsockname()], timeout=2, udp=False)
+    replies = client.exchange_many([as_req(n) for n in xrange(20)])
+    assert([int(r['error-code']) for r in replies] == range(20))
+
+    # With no reachable KDC, exchange should time out.
+    client = KDCClient([dead.getsockname()], timeout=0.2)
+    try:
+        client.exchange(as_req(1))
+        assert(False)
+    except KDCTimeout:
+        pass
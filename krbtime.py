@@ -0,0 +1,228 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module converts between KerberosTime strings (GeneralizedTime
+# in the form YYYYMMDDHHMMSSZ), seconds since the epoch, and datetime
+# objects.  KerberosTime has no fractional seconds; messages carry
+# microseconds in a separate field, so functions which deal in
+# microseconds use (seconds, usec) pairs.
+#
+# Strings are parsed by fixed offsets and built from cached date
+# prefixes and tables of the time of day fields, without going through
+# time.strptime() or strftime().  The string for the most recently
+# formatted second is also cached, since a server formats the current
+# time over and over.
+
+import datetime
+import time
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MAX_DATES = 4096
+
+# Caches of date prefixes ('YYYYMMDD') to days since the epoch and
+# back.
+_date_days = {}
+_day_dates = {}
+_last = (None, None)
+
+# 'HHMM' strings for each minute of the day and 'SS' strings for each
+# second (including a leap second), and their values in seconds.
+_SS = ['%02d' % i for i in xrange(61)]
+_HHMM = [hh + mm for hh in _SS[:24] for mm in _SS[:60]]
+_HHMM_SECS = dict(zip(_HHMM, xrange(0, 86400, 60)))
+_SS_SECS = dict(zip(_SS, xrange(61)))
+
+
+def _days_from_civil(y, m, d):
+    # Return the number of days from 1970-01-01 to the given date in
+    # the proleptic Gregorian calendar.
+    y -= m <= 2
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * (m + (-3 if m > 2 else 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def _civil_from_days(z):
+    # The inverse of _days_from_civil, returning (y, m, d).
+    z += 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    d = doy - (153 * mp + 2) // 5 + 1
+    m = mp + (3 if mp < 10 else -9)
+    return yoe + era * 400 + (m <= 2), m, d
+
+
+def _date_to_days(date):
+    days = _date_days.get(date)
+    if days is None:
+        if not date.isdigit():
+            raise ValueError('Malformed KerberosTime date %r' % date)
+        y, m, d = int(date[:4]), int(date[4:6]), int(date[6:])
+        days = _days_from_civil(y, m, d)
+        if not 1 <= m <= 12 or _civil_from_days(days) != (y, m, d):
+            raise ValueError('Invalid KerberosTime date %r' % date)
+        if len(_date_days) >= _MAX_DATES:
+            _date_days.clear()
+        _date_days[date] = days
+    return days
+
+
+def _days_to_date(days):
+    date = _day_dates.get(days)
+    if date is None:
+        date = '%04d%02d%02d' % _civil_from_days(days)
+        if len(_day_dates) >= _MAX_DATES:
+            _day_dates.clear()
+        _day_dates[days] = date
+    return date
+
+
+def from_string(s):
+    # Convert a KerberosTime string (or pyasn1 GeneralizedTime) to
+    # seconds since the epoch.  Raise ValueError if it is malformed.
+    s = str(s)
+    if len(s) != 15 or s[14] != 'Z':
+        raise ValueError('Malformed KerberosTime %r' % s)
+    try:
+        secs = _HHMM_SECS[s[8:12]] + _SS_SECS[s[12:14]]
+    except KeyError:
+        raise ValueError('Invalid KerberosTime %r' % s)
+    return _date_to_days(s[:8]) * 86400 + secs
+
+
+def to_string(t):
+    # Convert seconds since the epoch (truncated to a whole second) to
+    # a KerberosTime string.
+    global _last
+    t = int(t)
+    last = _last
+    if last[0] == t:
+        return last[1]
+    rem = t % 86400
+    s = _days_to_date(t // 86400) + _HHMM[rem // 60] + _SS[rem % 60] + 'Z'
+    _last = (t, s)
+    return s
+
+
+def now():
+    # Return the current time as (seconds, usec).
+    return split(time.time())
+
+
+def split(t):
+    # Split a float time into (seconds, usec).
+    sec = int(t // 1)
+    return sec, int((t - sec) * 1000000)
+
+
+def to_datetime(sec, usec=0):
+    # Return a naive datetime in UTC.
+    return _EPOCH + datetime.timedelta(seconds=sec, microseconds=usec)
+
+
+def from_datetime(dt):
+    # Convert a datetime to (seconds, usec).  Naive datetimes are taken
+    # to be in UTC.
+    offset = dt.utcoffset()
+    if offset is not None:
+        dt = dt.replace(tzinfo=None) - offset
+    delta = dt - _EPOCH
+    return delta.days * 86400 + delta.seconds, delta.microseconds
+
+
+def from_strings(strings):
+    # Convert a sequence of KerberosTime strings to a list of seconds
+    # since the epoch.
+    return [from_string(s) for s in strings]
+
+
+def to_strings(times):
+    # Convert a sequence of times to a list of KerberosTime strings.
+    # Times on the same day share a cached date prefix.
+    out = []
+    append = out.append
+    date_of = _days_to_date
+    hhmm, ss = _HHMM, _SS
+    for t in times:
+        t = int(t)
+        rem = t % 86400
+        append(date_of(t // 86400) + hhmm[rem // 60] + ss[rem % 60] + 'Z')
+    return out
+
+
+if __name__ == '__main__':
+    import calendar
+    import random
+
+    def ref_string(t):
+        return time.strftime('%Y%m%d%H%M%SZ', time.gmtime(t))
+
+    assert(to_string(0) == '19700101000000Z')
+    assert(from_string('19700101000000Z') == 0)
+    assert(to_string(1234567890) == '20090213233130Z')
+    assert(from_string('20090213233130Z') == 1234567890)
+    assert(from_string('20000229120000Z') ==
+           calendar.timegm((2000, 2, 29, 12, 0, 0)))
+    for bad in ('20090213233130', '2009021323313Z', '20091313233130Z',
+                '20090230000000Z', '20090213243130Z', '2009021323 130Z',
+                '200902132331+0Z'):
+        try:
+            from_string(bad)
+            assert(False)
+        except ValueError:
+            pass
+
+    # Agreement with the time module, one at a time and in batches.
+    rng = random.Random(0)
+    times = [rng.randrange(0, 2 ** 32) for i in xrange(2000)]
+    strings = [ref_string(t) for t in times]
+    assert([to_string(t) for t in times] == strings)
+    assert(to_strings(times) == strings)
+    assert(from_strings(strings) == times)
+
+    # datetime and usec conversions.
+    dt = datetime.datetime(2013, 5, 1, 12, 30, 15, 250000)
+    assert(from_datetime(dt) == (1367411415, 250000))
+    assert(to_datetime(1367411415, 250000) == dt)
+
+    class UTCMinus5(datetime.tzinfo):
+        def utcoffset(self, dt):
+            return datetime.timedelta(hours=-5)
+
+    assert(from_datetime(datetime.datetime(2013, 5, 1, 7, 30, 15, 250000,
+                                           UTCMinus5())) ==
+           (1367411415, 250000))
+    assert(split(1367411415.25) == (1367411415, 250000))
+    sec, usec = now()
+    assert(abs(sec - time.time()) < 2 and 0 <= usec < 1000000)
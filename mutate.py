@@ -0,0 +1,321 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module generates malformed variants of an encoded message (such
+# as an AS-REQ, TGS-REQ or AP-REQ) for robustness testing of a KDC,
+# working on the DER bytes instead of building pyasn1 objects.  The
+# message is parsed once into a map of its TLVs; each mutant replaces
+# one TLV (or truncates the message) and rewrites the lengths of the
+# enclosing TLVs, so that only the chosen part is malformed.
+#
+# The strategies are:
+#   tag: replace a TLV's tag with another tag
+#   length: give a TLV a wrong or non-minimal length encoding
+#   remove: remove a TLV
+#   duplicate: repeat a TLV
+#   integer: replace the value of an INTEGER with an extreme one
+#   contents: replace the contents of a primitive TLV with unusual
+#     contents for its type
+#   truncate: cut the message short
+#
+# A Mutator produces the same sequence of mutants for the same message,
+# seed and strategies.
+
+import random
+from struct import pack
+from der import encode_integer, encode_length, read_header
+
+
+def _tlvs(tag, contents):
+    return tuple(tag + encode_length(len(c)) + c for c in contents)
+
+
+_MAX_PREFIXES = 4096
+
+STRATEGIES = ('tag', 'length', 'remove', 'duplicate', 'integer',
+              'contents', 'truncate')
+
+_TAGS = ('\x01', '\x02', '\x03', '\x04', '\x05', '\x06', '\x0c', '\x18',
+         '\x1b', '\x30', '\x31', '\x60', '\x6a', '\x6c', '\x7e', '\xa0',
+         '\xa1', '\xa2', '\xbe', '\x1e', '\x9f')
+
+_INTEGERS = tuple(encode_integer(n) for n in (
+    0, 1, -1, 127, 128, -128, -129, 255, 256, 2 ** 31 - 1, 2 ** 31,
+    -2 ** 31, -2 ** 31 - 1, 2 ** 32 - 1, 2 ** 32, 2 ** 63 - 1, 2 ** 63,
+    -2 ** 63, 2 ** 64, 2 ** 1024)) + ('', '\x00\x05', '\xff\xff')
+
+# Unusual contents for primitive types, by tag.
+_CONTENTS = {
+    '\x03': ('', '\x00', '\x07\x80', '\x08\x00', '\x00\x00',
+             '\x00' + '\xff' * 64),
+    '\x18': ('', '19700101000000Z', '99991231235959Z', '20130101000000',
+             '2013010100000Z', '20131301000000Z', '20130101000000.5Z',
+             '2013010100000+Z', '\x00' * 15),
+    '\x1b': ('', '\x00', '/', '@', '\xff' * 8, 'A' * 4096),
+    '\x04': ('', '\x00', '\x30\x00', '\xff' * 4096),
+    '\x01': ('', '\x01', '\xff\xff')
+}
+_DEFAULT_CONTENTS = ('', '\x00', '\xff' * 16, 'A' * 1024)
+
+_INTEGER_TLVS = _tlvs('\x02', _INTEGERS)
+_CONTENT_TLVS = dict((tag, _tlvs(tag, c)) for tag, c in _CONTENTS.iteritems())
+
+
+def _bad_lengths(n):
+    # Return wrong and non-minimal encodings of the length n (which is
+    # below 2 ** 24).
+    der = encode_length(n)
+    if n < 0x80:
+        longer = '\x81' + der
+    else:
+        longer = chr(ord(der[0]) + 1) + '\x00' + der[1:]
+    return ('\x80', longer, '\x84' + pack('>L', n), '\x84\xff\xff\xff\xff',
+            '\x85\x00\x00\x00\x00\x00', encode_length(n + 1),
+            encode_length(n - 1 if n else 1), '\x7f')
+
+
+class Mutator(object):
+    # data is a DER-encoded message.  strategies is a sequence of
+    # strategy names, which may repeat names to weight them.
+    #
+    # Everything which does not depend on the random choices is
+    # computed here: for each TLV, the unchanged stretches of the
+    # message around the headers of its enclosing TLVs, and the
+    # replacements each strategy can choose from.
+    def __init__(self, data, seed=0, strategies=STRATEGIES):
+        for s in strategies:
+            if s not in STRATEGIES:
+                raise ValueError('Unknown mutation strategy %s' % s)
+        self.data = data
+        self.strategies = tuple(strategies)
+        self.rng = random.Random(seed)
+        # Each node is (tag, start, contents start, end, ancestors),
+        # where ancestors is a tuple of nodes from the outermost in.
+        self.nodes = []
+        self._parse(0, len(data), ())
+        if not self.nodes:
+            raise ValueError('No DER values in message')
+        self._plans = [self._plan(node) for node in self.nodes]
+        self._prefixes = {}
+        self._tag_rest = [data[n[1] + 1:n[3]] for n in self.nodes]
+        self._bad_lengths = [tuple(n[0] + l + data[n[2]:n[3]]
+                                   for l in _bad_lengths(n[3] - n[2]))
+                             for n in self.nodes]
+        self._doubles = [data[n[1]:n[3]] * 2 for n in self.nodes]
+        self._integers = [i for i, n in enumerate(self.nodes)
+                          if n[0] == '\x02']
+        self._primitives = [i for i, n in enumerate(self.nodes)
+                            if not ord(n[0]) & 0x20]
+        self._contents_tlvs = dict(
+            (i, _CONTENT_TLVS.get(self.nodes[i][0]) or
+             _tlvs(self.nodes[i][0], _DEFAULT_CONTENTS))
+            for i in self._primitives)
+        self._strategy = {
+            'tag': self._tag,
+            'length': self._length,
+            'remove': self._remove,
+            'duplicate': self._duplicate,
+            'integer': self._integer,
+            'contents': self._contents,
+            'truncate': self._truncate
+        }
+        self.last = None
+
+    def _parse(self, off, end, ancestors):
+        data = self.data
+        while off < end:
+            tag, cstart, cend = read_header(data, off, end)
+            node = (data[off], off, cstart, cend, ancestors)
+            self.nodes.append(node)
+            if tag & 0x20:
+                self._parse(cstart, cend, ancestors + (node,))
+            off = cend
+
+    def _plan(self, node):
+        # Return (gaps, headers, size, suffix) for replacing node.
+        # gaps are the stretches of the message before each enclosing
+        # header and before node; headers are (tag, contents length,
+        # header length) for each enclosing TLV, innermost first.
+        tag, start, cstart, end, ancestors = node
+        data = self.data
+        gaps = []
+        prev = 0
+        for a in ancestors:
+            gaps.append(data[prev:a[1]])
+            prev = a[2]
+        gaps.append(data[prev:start])
+        headers = tuple((a[0], a[3] - a[2], a[2] - a[1])
+                        for a in reversed(ancestors))
+        return tuple(gaps), headers, end - start, data[end:]
+
+    def _prefix(self, i, n):
+        # Return the part of the message before node i when node i is
+        # replaced by n bytes, with the lengths of the enclosing TLVs
+        # adjusted.
+        gaps, headers, size, suffix = self._plans[i]
+        delta = n - size
+        parts = [gaps[-1]]
+        k = len(headers)
+        for j in xrange(k):
+            tag, clen, hlen = headers[j]
+            h = tag + encode_length(clen + delta)
+            delta += len(h) - hlen
+            parts.append(h)
+            parts.append(gaps[k - 1 - j])
+        parts.reverse()
+        return ''.join(parts)
+
+    def _splice(self, i, x):
+        # Return the message with node i replaced by x.  The prefix
+        # depends only on the node and the length of x, and the
+        # strategies draw from a limited set of replacements, so
+        # prefixes are cached.
+        key = (i, len(x))
+        prefix = self._prefixes.get(key)
+        if prefix is None:
+            prefix = self._prefix(i, len(x))
+            if len(self._prefixes) >= _MAX_PREFIXES:
+                self._prefixes.clear()
+            self._prefixes[key] = prefix
+        return ''.join((prefix, x, self._plans[i][3]))
+
+    def _tag(self, r):
+        i = int(r() * len(self.nodes))
+        tag = _TAGS[int(r() * len(_TAGS))]
+        if tag == self.nodes[i][0]:
+            tag = chr(ord(tag) ^ 0x20)
+        return i, tag + self._tag_rest[i]
+
+    def _length(self, r):
+        i = int(r() * len(self.nodes))
+        choices = self._bad_lengths[i]
+        return i, choices[int(r() * len(choices))]
+
+    def _remove(self, r):
+        return int(r() * len(self.nodes)), ''
+
+    def _duplicate(self, r):
+        i = int(r() * len(self.nodes))
+        return i, self._doubles[i]
+
+    def _integer(self, r):
+        if not self._integers:
+            return self._contents(r)
+        i = self._integers[int(r() * len(self._integers))]
+        return i, _INTEGER_TLVS[int(r() * len(_INTEGER_TLVS))]
+
+    def _contents(self, r):
+        if not self._primitives:
+            return self._tag(r)
+        i = self._primitives[int(r() * len(self._primitives))]
+        choices = self._contents_tlvs[i]
+        return i, choices[int(r() * len(choices))]
+
+    def _truncate(self, r):
+        return None, self.data[:int(r() * len(self.data))]
+
+    def mutate(self):
+        # Return one mutant.  last is set to the strategy name and the
+        # node mutated (None for truncation).
+        r = self.rng.random
+        name = self.strategies[int(r() * len(self.strategies))]
+        i, x = self._strategy[name](r)
+        if i is None:
+            self.last = (name, None)
+            return x
+        self.last = (name, self.nodes[i])
+        return self._splice(i, x)
+
+    def mutants(self, count):
+        for i in xrange(count):
+            yield self.mutate()
+
+
+if __name__ == '__main__':
+    import time
+    from pyasn1.codec.der import decoder, encoder
+    import asn1
+
+    req = asn1.ASReq()
+    req['pvno'] = 5
+    req['msg-type'] = 10
+    req['req-body'] = None
+    body = req['req-body']
+    body['kdc-options'] = "'01000000100000000000000000010000'B"
+    body['cname'] = None
+    body['cname']['name-type'] = 1
+    body['cname']['name-string'] = None
+    body['cname']['name-string'][0] = 'user'
+    body['realm'] = 'KRBTEST.COM'
+    body['sname'] = None
+    body['sname']['name-type'] = 2
+    body['sname']['name-string'] = None
+    body['sname']['name-string'][0] = 'krbtgt'
+    body['sname']['name-string'][1] = 'KRBTEST.COM'
+    body['till'] = '20370101000000Z'
+    body['nonce'] = 12345
+    body['etype'] = None
+    for i, e in enumerate((18, 17, 16, 23)):
+        body['etype'][i] = e
+    data = encoder.encode(req)
+
+    # Runs are reproducible from the seed.
+    a = list(Mutator(data, 1).mutants(1000))
+    assert(a == list(Mutator(data, 1).mutants(1000)))
+    assert(a != list(Mutator(data, 2).mutants(1000)))
+    assert(len(set(a)) > 500 and data not in a)
+
+    # Replacing a node with itself gives back the message.
+    m = Mutator(data)
+    for i, node in enumerate(m.nodes):
+        assert(m._splice(i, data[node[1]:node[3]]) == data)
+
+    # Enclosing lengths are fixed up, so mutants which only change
+    # whole TLVs still parse, including where a length crosses 128.
+    m = Mutator(data, 3, ('remove', 'duplicate', 'integer', 'contents'))
+    for mutant in m.mutants(2000):
+        if m.last[1][4]:
+            Mutator(mutant)
+    m = Mutator(data, 4, ('length', 'tag'))
+    for mutant in m.mutants(2000):
+        if m.last[1][4]:
+            assert(read_header(mutant, 0, len(mutant))[2] == len(mutant))
+
+    # Removing the optional cname leaves a valid request.
+    m = Mutator(data)
+    cname = [i for i, n in enumerate(m.nodes)
+             if n[0] == '\xa1' and len(n[4]) == 4][0]
+    out = decoder.decode(m._splice(cname, ''), asn1Spec=asn1.ASReq())[0]
+    assert(out['req-body'].getComponentByName('cname') is None)
+    assert(int(out['req-body']['nonce']) == 12345)
+
+    try:
+        Mutator(data, strategies=('bogus',))
+        assert(False)
+    except ValueError:
+        pass
@@ -0,0 +1,279 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module converts between principal name strings such as
+# "HTTP/host.example.com@EXAMPLE.COM" and Principal objects, using the
+# RFC 1964 section 2.1.1 quoting rules.  Principal objects are
+# immutable and hashable, and compare by realm and components (not
+# name type, as in MIT krb5).
+#
+# parse() and from_asn1() return interned objects, so equal principals
+# are usually the same object and compare in constant time; unequal
+# principals almost always differ in their cached hash values.  The
+# intern and parse caches are bounded; entries are dropped oldest
+# first when they fill up, after which an equal but distinct object
+# may be returned.
+
+import threading
+from collections import OrderedDict
+import asn1
+from asn1 import NameType
+
+
+MAX_CACHED = 65536
+
+_escapes = {'\n': '\\n', '\t': '\\t', '\b': '\\b', '\0': '\\0',
+            '\\': '\\\\', '/': '\\/', '@': '\\@'}
+_unescapes = {'n': '\n', 't': '\t', 'b': '\b', '0': '\0'}
+_special = frozenset(_escapes)
+
+
+def _quote(s, realm=False):
+    if not _special.intersection(s):
+        return s
+    return ''.join(c if c not in _escapes or (realm and c == '/')
+                   else _escapes[c] for c in s)
+
+
+class Principal(object):
+    __slots__ = ('components', 'realm', 'name_type', '_hash', '_str',
+                 '_name', '__weakref__')
+
+    def __init__(self, components, realm, name_type=NameType.PRINCIPAL):
+        components = tuple(str(c) for c in components)
+        realm = str(realm)
+        object.__setattr__(self, 'components', components)
+        object.__setattr__(self, 'realm', realm)
+        object.__setattr__(self, 'name_type', name_type)
+        object.__setattr__(self, '_hash', hash((components, realm)))
+        object.__setattr__(self, '_str', None)
+        object.__setattr__(self, '_name', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Principal objects are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Principal objects are immutable')
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        return (isinstance(other, Principal) and self._hash == other._hash and
+                self.realm == other.realm and
+                self.components == other.components)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return (Principal, (self.components, self.realm, self.name_type))
+
+    def __str__(self):
+        if self._str is None:
+            s = ('/'.join(_quote(c) for c in self.components) + '@' +
+                 _quote(self.realm, True))
+            object.__setattr__(self, '_str', s)
+        return self._str
+
+    def __repr__(self):
+        return 'Principal(%r)' % str(self)
+
+    def principal_name(self):
+        # Return a frozen asn1.PrincipalName for the principal, which
+        # may be assigned into any number of messages.
+        if self._name is None:
+            name = asn1.PrincipalName()
+            name['name-type'] = self.name_type
+            name['name-string'] = None
+            for i, c in enumerate(self.components):
+                name['name-string'][i] = c
+            object.__setattr__(self, '_name', name.freeze())
+        return self._name
+
+
+_lock = threading.Lock()
+_interned = OrderedDict()
+_parsed = OrderedDict()
+
+
+def _remember(cache, key, value):
+    # Add value to a bounded cache, unless another thread got there
+    # first, and return the cached value.
+    with _lock:
+        value = cache.setdefault(key, value)
+        if len(cache) > MAX_CACHED:
+            cache.popitem(last=False)
+    return value
+
+
+def intern_principal(p):
+    # Return the interned Principal equal to p with the same name type,
+    # interning p if there is none.
+    key = (p.components, p.realm, p.name_type)
+    found = _interned.get(key)
+    if found is not None:
+        return found
+    return _remember(_interned, key, p)
+
+
+def _split(s):
+    # Split a principal string into its unquoted components and realm
+    # (or None if there is no realm).
+    if '\\' not in s:
+        name, sep, realm = s.partition('@')
+        if '@' in realm:
+            raise ValueError('Malformed principal name %r' % s)
+        return name.split('/'), (realm if sep else None)
+    components = []
+    realm = None
+    cur = []
+    it = iter(s)
+    for c in it:
+        if c == '\\':
+            c = next(it, None)
+            if c is None:
+                raise ValueError('Trailing backslash in %r' % s)
+            cur.append(_unescapes.get(c, c))
+        elif c == '@':
+            if realm is not None:
+                raise ValueError('Malformed principal name %r' % s)
+            components.append(''.join(cur))
+            cur = []
+            realm = cur
+        elif c == '/' and realm is None:
+            components.append(''.join(cur))
+            cur = []
+        else:
+            cur.append(c)
+    if realm is None:
+        components.append(''.join(cur))
+        return components, None
+    return components, ''.join(realm)
+
+
+def parse(s, default_realm=None, name_type=None):
+    # Parse a principal string, using default_realm if it has no realm.
+    # With no name_type, krbtgt/REALM principals are given type
+    # SRV_INST and others type PRINCIPAL.  Raise ValueError if the
+    # string is malformed or has no realm and no default is given.
+    key = (s, default_realm, name_type)
+    p = _parsed.get(key)
+    if p is not None:
+        return p
+    components, realm = _split(s)
+    if realm is None:
+        if default_realm is None:
+            raise ValueError('Principal name %r has no realm' % s)
+        realm = default_realm
+    if name_type is None:
+        if len(components) == 2 and components[0] == 'krbtgt':
+            name_type = NameType.SRV_INST
+        else:
+            name_type = NameType.PRINCIPAL
+    p = intern_principal(Principal(components, realm, name_type))
+    return _remember(_parsed, key, p)
+
+
+def unparse(p):
+    return str(p)
+
+
+def from_asn1(name, realm):
+    # Return the interned Principal for an asn1.PrincipalName and realm.
+    p = Principal([str(c) for c in name['name-string']], str(realm),
+                  int(name['name-type']))
+    return intern_principal(p)
+
+
+def clear():
+    with _lock:
+        _interned.clear()
+        _parsed.clear()
+
+
+if __name__ == '__main__':
+    from pyasn1.codec.der import encoder
+
+    p = parse('HTTP/host.example.com@EXAMPLE.COM')
+    assert(p.components == ('HTTP', 'host.example.com'))
+    assert(p.realm == 'EXAMPLE.COM' and p.name_type == NameType.PRINCIPAL)
+    assert(str(p) == 'HTTP/host.example.com@EXAMPLE.COM')
+    assert(parse('HTTP/host.example.com@EXAMPLE.COM') is p)
+    assert(parse('HTTP/host.example.com', 'EXAMPLE.COM') is p)
+    assert(Principal(['HTTP', 'host.example.com'], 'EXAMPLE.COM') == p)
+    assert(intern_principal(Principal(['HTTP', 'host.example.com'],
+                                      'EXAMPLE.COM')) is p)
+    assert(parse('krbtgt/A@A').name_type == NameType.SRV_INST)
+    assert(parse('user@A') != parse('user@B'))
+    assert(len(set([parse('user@A'), Principal(['user'], 'A'),
+                    parse('user@B')])) == 2)
+
+    # Quoting round trips.
+    for s, components, realm in (
+        (r'user\@example.com@EXAMPLE.COM', ('user@example.com',),
+         'EXAMPLE.COM'),
+        (r'a\/b/c\\d@R', ('a/b', 'c\\d'), 'R'),
+        (r'x\n\t\b\0@R', ('x\n\t\b\0',), 'R'),
+        (r'/@R', ('', ''), 'R'),
+        (r'u@R/S\@T', ('u',), 'R/S@T')):
+        p = parse(s)
+        assert(p.components == components and p.realm == realm)
+        assert(str(p) == s and parse(str(p)) is p)
+    assert(parse(r'\q@R').components == ('q',))
+    for bad in ('user@A@B', 'user@A\\', 'noreal\\m'):
+        try:
+            parse(bad)
+            assert(False)
+        except ValueError:
+            pass
+
+    # ASN.1 conversion.
+    p = parse('host/www.example.com@R', name_type=NameType.SRV_HOST)
+    name = p.principal_name()
+    assert(name.isFrozen() and p.principal_name() is name)
+    assert(from_asn1(name, 'R') is p)
+    unfrozen = asn1.PrincipalName()
+    unfrozen['name-type'] = NameType.SRV_HOST
+    unfrozen['name-string'] = None
+    unfrozen['name-string'][0] = 'host'
+    unfrozen['name-string'][1] = 'www.example.com'
+
+    def ticket(sname):
+        t = asn1.Ticket()
+        t['tkt-vno'] = 5
+        t['realm'] = 'R'
+        t['sname'] = sname
+        t['enc-part'] = None
+        t['enc-part']['etype'] = 18
+        t['enc-part']['cipher'] = ''
+        return encoder.encode(t)
+
+    assert(ticket(name) == ticket(unfrozen))
@@ -0,0 +1,121 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module hands out random bytes from buffers filled in large
+# blocks from the operating system CSPRNG, so that the many small
+# requests made for confounders, nonces and keys share the cost of
+# each call to os.urandom().  Each thread draws from its own buffer,
+# so no locking is needed, and a buffer is discarded in a forked
+# child so that parent and child never share random bytes.  Bytes are
+# never handed out twice.
+
+import threading
+from os import getpid, urandom
+from struct import unpack
+
+
+class _State(threading.local):
+    buf = ''
+    pos = 0
+    pid = None
+
+
+class RandomPool(object):
+    # Requests of more than blocksize bytes go directly to source.
+    def __init__(self, blocksize=4096, source=urandom):
+        self.blocksize = blocksize
+        self.source = source
+        self._state = _State()
+
+    def get_bytes(self, n):
+        s = self._state
+        pos = s.pos
+        end = pos + n
+        if end > len(s.buf) or s.pid != getpid():
+            if n > self.blocksize:
+                return self.source(n)
+            s.buf = self.source(self.blocksize)
+            s.pid = getpid()
+            pos, end = 0, n
+        s.pos = end
+        return s.buf[pos:end]
+
+    def confounder(self, size):
+        return self.get_bytes(size)
+
+    def nonce(self):
+        # Return a random KDC-REQ nonce.  The protocol allows 32 bits,
+        # but some implementations treat the nonce as signed, so the
+        # top bit is kept clear.
+        return unpack('>L', self.get_bytes(4))[0] & 0x7fffffff
+
+    def clear(self):
+        # Discard the buffered bytes of every thread.
+        self._state = _State()
+
+
+_pool = RandomPool()
+get_bytes = _pool.get_bytes
+confounder = _pool.confounder
+nonce = _pool.nonce
+
+
+if __name__ == '__main__':
+    calls = []
+
+    def source(n):
+        calls.append(n)
+        return urandom(n)
+
+    p = RandomPool(64, source)
+    out = [p.get_bytes(8) for i in xrange(8)]
+    assert(calls == [64] and ''.join(out) == p._state.buf)
+    p.get_bytes(1)
+    assert(calls == [64, 64])
+    assert(len(p.get_bytes(1000)) == 1000 and calls[-1] == 1000)
+    assert(0 <= p.nonce() < 2 ** 31)
+
+    # Threads draw from separate buffers.
+    t = threading.Thread(target=p.get_bytes, args=(8,))
+    t.start()
+    t.join()
+    assert(calls == [64, 64, 1000, 64])
+
+    # A forked child refills the pool instead of reusing the parent's
+    # buffered bytes.
+    import os
+    if hasattr(os, 'fork'):
+        r, w = os.pipe()
+        p.clear()
+        p.get_bytes(1)
+        pid = os.fork()
+        if pid == 0:
+            os.write(w, p.get_bytes(16))
+            os._exit(0)
+        os.waitpid(pid, 0)
+        assert(os.read(r, 16) != p.get_bytes(16))
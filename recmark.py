@@ -0,0 +1,189 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module splits a stream of record-marked Kerberos messages (as
+# sent over TCP, RFC 4120 section 7.2.2) into individual messages.
+# Data is fed to a RecordDecoder in chunks of any size, and each
+# complete message is returned as a memoryview paired with the asn1
+# class for its application tag, without copying the message out of
+# the receive buffer.
+#
+# The buffer has a fixed capacity and is never resized in place.
+# When it fills up, the unconsumed tail is moved to a new buffer, so
+# memoryviews handed out earlier keep referring to the old one and
+# remain valid indefinitely.
+
+from struct import unpack_from
+from pyasn1.codec.der import decoder
+import asn1
+
+
+# Application tag numbers of the messages which are sent over the
+# wire, and their asn1 classes.
+MESSAGE_TYPES = {
+    10: asn1.ASReq,
+    11: asn1.ASRep,
+    12: asn1.TGSReq,
+    13: asn1.TGSRep,
+    14: asn1.APReq,
+    30: asn1.KrbError
+}
+
+DEFAULT_MAX_SIZE = 1 << 20
+
+
+class RecordTooLarge(ValueError):
+    pass
+
+
+def message_type(msg, types=MESSAGE_TYPES):
+    # Return the class for the application tag of msg (a string or
+    # buffer), or None if it is not one of types.
+    if len(msg) == 0:
+        return None
+    b = ord(msg[0])
+    if b & 0xe0 != 0x60:
+        return None
+    return types.get(b & 0x1f)
+
+
+def decode(cls, msg):
+    # Decode a message returned by RecordDecoder.feed().
+    return decoder.decode(msg.tobytes(), asn1Spec=cls())[0]
+
+
+class RecordDecoder(object):
+    # Messages longer than max_size bytes (excluding the length prefix)
+    # cause feed() to raise RecordTooLarge; the decoder is unusable
+    # afterwards, and the connection should be dropped.  types maps
+    # application tag numbers to classes.  bufsize is the initial
+    # buffer capacity.
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, types=MESSAGE_TYPES,
+                 bufsize=4096):
+        self.max_size = max_size
+        self.types = types
+        self._buf = bytearray(bufsize)
+        self._start = 0
+        self._end = 0
+        self._failed = False
+
+    def __len__(self):
+        # Return the number of buffered bytes not yet returned.
+        return self._end - self._start
+
+    def _reserve(self, n):
+        # Make room for n more bytes after the buffered data, moving the
+        # data to a new buffer if necessary.
+        if self._end + n <= len(self._buf):
+            return
+        used = self._end - self._start
+        size = len(self._buf)
+        while size < 2 * (used + n):
+            size *= 2
+        buf = bytearray(size)
+        buf[:used] = self._buf[self._start:self._end]
+        self._buf = buf
+        self._start = 0
+        self._end = used
+
+    def feed(self, data):
+        # Add data to the stream and return a list of (class,
+        # memoryview) pairs for the messages it completes, in order.
+        # class is None for messages without a known application tag.
+        if self._failed:
+            raise RecordTooLarge('Decoder has failed')
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+        out = []
+        buf, start, end = self._buf, self._start, self._end
+        view = memoryview(buf)
+        while end - start >= 4:
+            (msglen,) = unpack_from('>L', buf, start)
+            if msglen > self.max_size:
+                self._failed = True
+                raise RecordTooLarge('Record length %d exceeds %d' %
+                                     (msglen, self.max_size))
+            if end - start - 4 < msglen:
+                break
+            msg = view[start + 4:start + 4 + msglen]
+            out.append((message_type(msg, self.types), msg))
+            start += 4 + msglen
+        self._start = start
+        return out
+
+
+if __name__ == '__main__':
+    from struct import pack
+    from pyasn1.codec.der import encoder
+
+    def krb_error(code):
+        err = asn1.KrbError()
+        err['pvno'] = 5
+        err['msg-type'] = 30
+        err['stime'] = '20130101000000Z'
+        err['susec'] = 0
+        err['error-code'] = code
+        err['realm'] = 'KRBTEST.COM'
+        err['sname'] = None
+        err['sname']['name-type'] = asn1.NameType.SRV_INST
+        err['sname']['name-string'] = None
+        err['sname']['name-string'][0] = 'krbtgt'
+        return encoder.encode(err)
+
+    msgs = [krb_error(i) for i in xrange(50)] + ['\x6b\x00', '', '\x30\x00']
+    stream = ''.join(pack('>L', len(m)) + m for m in msgs)
+
+    # Any chunking of the stream produces the same messages, and
+    # views returned earlier are unaffected by later data.
+    for chunksize in (1, 3, 7, 100, len(stream)):
+        d = RecordDecoder(bufsize=16)
+        out = []
+        for off in xrange(0, len(stream), chunksize):
+            out.extend(d.feed(stream[off:off+chunksize]))
+        assert(len(d) == 0)
+        assert([m.tobytes() for cls, m in out] == msgs)
+        assert([cls for cls, m in out] ==
+               [asn1.KrbError] * 50 + [asn1.ASRep, None, None])
+        assert(int(decode(*out[7])['error-code']) == 7)
+
+    # Oversized records are rejected as soon as the length is seen.
+    d = RecordDecoder(max_size=100)
+    assert(d.feed(pack('>L', 100) + 'x' * 50) == [])
+    d = RecordDecoder(max_size=100)
+    try:
+        d.feed(pack('>L', 101))
+        assert(False)
+    except RecordTooLarge:
+        pass
+    try:
+        d.feed('x')
+        assert(False)
+    except RecordTooLarge:
+        pass
@@ -0,0 +1,279 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module follows cross-realm referrals to obtain service tickets
+# in other realms.  The realm path discovered for each target realm
+# (or, when the realm is not known, each host domain) is remembered,
+# along with the cross-realm TGTs obtained along the way.  Later
+# requests for the same target start from the last cached TGT on the
+# path, and go back to discovery from the local realm if the cached
+# path no longer works.
+
+import threading
+import time
+import asn1
+from tktcache import CacheEntry
+
+
+class ReferralLoop(ValueError):
+    pass
+
+
+def _krbtgt_name(realm):
+    name = asn1.PrincipalName()
+    name['name-type'] = asn1.NameType.SRV_INST
+    name['name-string'] = None
+    name['name-string'][0] = 'krbtgt'
+    name['name-string'][1] = realm
+    return name
+
+
+def _referral_realm(entry):
+    # Return the realm a TGS reply refers us to, or None if the reply
+    # contains the requested ticket rather than a cross-realm TGT.
+    sname = entry.enc_part['sname']['name-string']
+    srealm = str(entry.enc_part['srealm'])
+    if len(sname) == 2 and str(sname[0]) == 'krbtgt':
+        if str(sname[1]) != srealm:
+            return str(sname[1])
+    return None
+
+
+def _host_domain(sname):
+    # Return the domain part of a host-based service name, or None.
+    strings = sname['name-string']
+    if int(sname['name-type']) != asn1.NameType.SRV_HOST or len(strings) < 2:
+        return None
+    host = str(strings[1]).lower()
+    return host.split('.', 1)[1] if '.' in host else None
+
+
+class ReferralResolver(object):
+    # tgs is called as tgs(tgt, sname, realm), where tgt is a
+    # CacheEntry for a TGT usable at realm, and must return a
+    # (ticket, key, enc_part) tuple from the TGS reply of realm's KDC.
+    # The reply may be a referral (a krbtgt/NEXT@realm ticket) or the
+    # requested ticket.  clock may be replaced for testing.
+    def __init__(self, tgs, max_hops=10, clock=time.time):
+        self.tgs = tgs
+        self.max_hops = max_hops
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._paths = {}
+        self._tgts = {}
+
+    def _path_keys(self, local, sname, target_realm):
+        keys = []
+        if target_realm is not None:
+            keys.append((local, 'realm', target_realm))
+        domain = _host_domain(sname)
+        if domain is not None:
+            keys.append((local, 'domain', domain))
+        return keys
+
+    def _cached_tgt(self, client, frm, to):
+        with self._lock:
+            entry = self._tgts.get((client, frm, to))
+            if entry is not None and entry.endtime <= self.clock():
+                del self._tgts[(client, frm, to)]
+                entry = None
+            return entry
+
+    def _store_tgt(self, client, frm, to, entry):
+        with self._lock:
+            now = self.clock()
+            for k in [k for k, e in self._tgts.iteritems()
+                      if e.endtime <= now]:
+                del self._tgts[k]
+            self._tgts[(client, frm, to)] = entry
+
+    def _store_path(self, keys, path):
+        with self._lock:
+            for k in keys:
+                self._paths[k] = path
+
+    def _request(self, tgt, sname, realm):
+        return CacheEntry(*self.tgs(tgt, sname, realm))
+
+    def _follow_path(self, tgt, client, sname, path):
+        # Get the service ticket along a known realm path, starting
+        # from the furthest cross-realm TGT still in the cache.
+        # Return None if the path does not lead to the ticket.
+        i = len(path) - 1
+        while i > 0:
+            cached = self._cached_tgt(client, path[i-1], path[i])
+            if cached is not None:
+                tgt = cached
+                break
+            i -= 1
+        while i < len(path) - 1:
+            entry = self._request(tgt, _krbtgt_name(path[i+1]), path[i])
+            if _referral_realm(entry) != path[i+1]:
+                return None
+            self._store_tgt(client, path[i], path[i+1], entry)
+            tgt = entry
+            i += 1
+        entry = self._request(tgt, sname, path[-1])
+        return None if _referral_realm(entry) is not None else entry
+
+    def _discover(self, tgt, client, sname, local):
+        # Follow referrals from the local realm.  Return the service
+        # ticket entry and the realm path taken.
+        path = [local]
+        for hop in xrange(self.max_hops):
+            entry = self._request(tgt, sname, path[-1])
+            nxt = _referral_realm(entry)
+            if nxt is None:
+                return entry, path
+            if nxt in path:
+                raise ReferralLoop('Referral loop at realm %s' % nxt)
+            self._store_tgt(client, path[-1], nxt, entry)
+            path.append(nxt)
+            tgt = entry
+        raise ReferralLoop('Too many referral hops')
+
+    def resolve(self, tgt, client, sname, target_realm=None):
+        # Return a CacheEntry for a ticket to sname, using tgt (a
+        # CacheEntry for the client's local TGT).  target_realm is the
+        # service realm if the caller knows it.
+        local = str(tgt.enc_part['srealm'])
+        keys = self._path_keys(local, sname, target_realm)
+        with self._lock:
+            path = None
+            for k in keys:
+                path = self._paths.get(k)
+                if path is not None:
+                    break
+        if path is not None:
+            entry = self._follow_path(tgt, client, sname, path)
+            if entry is not None:
+                return entry
+            with self._lock:
+                for k in keys:
+                    self._paths.pop(k, None)
+        entry, path = self._discover(tgt, client, sname, local)
+        self._store_path(keys + [(local, 'realm', path[-1])], path)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._paths.clear()
+            self._tgts.clear()
+
+
+if __name__ == '__main__':
+    now = [1000000000]
+    nexthop = {'A': 'B', 'B': 'C'}
+    calls = []
+
+    def enc_part(sname, srealm, lifetime=3600):
+        p = asn1.EncTGSRepPart()
+        p['authtime'] = time.strftime('%Y%m%d%H%M%SZ', time.gmtime(now[0]))
+        p['endtime'] = time.strftime('%Y%m%d%H%M%SZ',
+                                     time.gmtime(now[0] + lifetime))
+        p['srealm'] = srealm
+        p['sname'] = sname
+        return p
+
+    # A fake forest in which A trusts B and B trusts C, and services
+    # in example.c are in realm C.
+    def tgs(tgt, sname, realm):
+        assert(str(tgt.enc_part['sname']['name-string'][1]) == realm)
+        calls.append(realm)
+        strings = [str(s) for s in sname['name-string']]
+        if strings[0] == 'krbtgt' and strings[1] == nexthop.get(realm):
+            return None, None, enc_part(sname, realm)
+        if realm == 'C' and not strings[1].endswith('.d'):
+            return None, None, enc_part(sname, realm, 600)
+        return None, None, enc_part(_krbtgt_name(nexthop[realm]), realm)
+
+    def service(host):
+        name = asn1.PrincipalName()
+        name['name-type'] = asn1.NameType.SRV_HOST
+        name['name-string'] = None
+        name['name-string'][0] = 'host'
+        name['name-string'][1] = host
+        return name
+
+    local_tgt = CacheEntry(None, None, enc_part(_krbtgt_name('A'), 'A', 9999))
+    r = ReferralResolver(tgs, clock=lambda: now[0])
+
+    # Discovery takes one hop per realm; later requests for the same
+    # domain or realm go straight to the last realm.
+    e = r.resolve(local_tgt, 'user@A', service('www.example.c'))
+    assert(calls == ['A', 'B', 'C'])
+    assert(str(e.enc_part['srealm']) == 'C')
+    del calls[:]
+    r.resolve(local_tgt, 'user@A', service('ftp.example.c'))
+    r.resolve(local_tgt, 'user@A', service('other'), 'C')
+    assert(calls == ['C', 'C'])
+
+    # When the last cross-realm TGT expires, the earlier one is used
+    # to get a new one.
+    del calls[:]
+    now[0] += 3600
+    r._tgts[('user@A', 'A', 'B')] = CacheEntry(
+        None, None, enc_part(_krbtgt_name('B'), 'A'))
+    r.resolve(local_tgt, 'user@A', service('www.example.c'))
+    assert(calls == ['B', 'C'])
+
+    # A stale path falls back to discovery.
+    del calls[:]
+    r._paths[('A', 'domain', 'example.c')] = ['A', 'X']
+    r.resolve(local_tgt, 'user@A', service('www.example.c'))
+    assert(calls[-3:] == ['A', 'B', 'C'])
+
+    # Errors on a cached path are raised rather than hidden by a new
+    # discovery.
+    def failing_tgs(tgt, sname, realm):
+        calls.append(realm)
+        raise ValueError('KDC error')
+    r.tgs = failing_tgs
+    del calls[:]
+    try:
+        r.resolve(local_tgt, 'user@A', service('www.example.c'))
+        assert(False)
+    except ValueError:
+        pass
+    assert(calls == ['C'])
+    r.tgs = tgs
+
+    # Only host-based names are cached by domain.
+    admin = service('admin.example.e')
+    admin['name-type'] = asn1.NameType.PRINCIPAL
+    assert(r._path_keys('A', admin, None) == [])
+    assert(r._path_keys('A', service('x.example.e'), None) ==
+           [('A', 'domain', 'example.e')])
+
+    # Referral loops are detected.
+    nexthop['C'] = 'A'
+    try:
+        r.resolve(local_tgt, 'user@A', service('www.example.d'), 'D')
+        assert(False)
+    except ReferralLoop:
+        pass
@@ -0,0 +1,255 @@
+# Copyright (C) 2013 by the Massachusetts Institute of Technology.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in
+#   the documentation and/or other materials provided with the
+#   distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module implements an in-memory cache of service tickets, keyed
+# by (client principal, server principal, enctype).  Principals may be
+# any hashable values the caller chooses.  Entries are removed when
+# their endtime passes and the least recently used entries are
+# dropped when the cache is full.  A lookup which finds an entry close
+# to expiry fetches a replacement while other threads continue to use
+# the old entry, and concurrent lookups which miss on the same key
+# share a single fetch.
+
+import heapq
+import threading
+import time
+from collections import OrderedDict
+import krbtime
+
+
+class CacheEntry(object):
+    # A cached service ticket.  ticket is an asn1.Ticket, key is the
+    # crypto.Key session key, and enc_part is the EncKDCRepPart from
+    # the reply which issued the ticket.
+    def __init__(self, ticket, key, enc_part):
+        self.ticket = ticket
+        self.key = key
+        self.enc_part = enc_part
+        self.authtime = krbtime.from_string(enc_part['authtime'])
+        self.endtime = krbtime.from_string(enc_part['endtime'])
+        start = enc_part.getComponentByName('starttime')
+        renew = enc_part.getComponentByName('renew-till')
+        self.starttime = (self.authtime if start is None
+                          else krbtime.from_string(start))
+        self.renew_till = (None if renew is None
+                           else krbtime.from_string(renew))
+
+
+class _Fetch(object):
+    # A fetch in progress, shared by all threads waiting on its key.
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+        self.error = None
+
+
+class TicketCache(object):
+    # fetch is called as fetch(client, server, enctype) on a cache
+    # miss and must return a (ticket, key, enc_part) tuple, typically
+    # by making a TGS request.  Entries within renew_margin seconds of
+    # their endtime are refreshed on lookup.  clock may be replaced for
+    # testing.
+    def __init__(self, fetch, maxsize=1024, renew_margin=300,
+                 clock=time.time):
+        self.fetch = fetch
+        self.maxsize = maxsize
+        self.renew_margin = renew_margin
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._expiry = []
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self, now):
+        # Remove entries whose endtime has passed.  Heap items for
+        # replaced or evicted entries are skipped.
+        heap = self._expiry
+        while heap and heap[0][0] <= now:
+            endtime, key, entry = heapq.heappop(heap)
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+
+    def _store(self, key, entry):
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        heapq.heappush(self._expiry, (entry.endtime, key, entry))
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        if len(self._expiry) > 2 * self.maxsize:
+            # Too many stale heap items; rebuild the heap.
+            self._expiry = [(e.endtime, k, e)
+                            for k, e in self._entries.iteritems()]
+            heapq.heapify(self._expiry)
+
+    def put(self, client, server, enctype, ticket, key, enc_part):
+        entry = CacheEntry(ticket, key, enc_part)
+        with self._lock:
+            self._store((client, server, enctype), entry)
+        return entry
+
+    def remove(self, client, server, enctype):
+        with self._lock:
+            self._entries.pop((client, server, enctype), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expiry = []
+
+    def get(self, client, server, enctype):
+        # Return a CacheEntry for the given key, fetching a ticket if
+        # there is no usable entry.  Exceptions from the fetch function
+        # are raised to every thread waiting on the fetch.
+        key = (client, server, enctype)
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = self._entries.pop(key)
+                if (entry.endtime - now > self.renew_margin or
+                    key in self._inflight):
+                    return entry
+            pending = self._inflight.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._inflight[key] = _Fetch()
+
+        if not owner:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.entry
+
+        try:
+            pending.entry = CacheEntry(*self.fetch(client, server, enctype))
+        except Exception as e:
+            pending.error = e
+        finally:
+            # Release the waiters even if the fetch was interrupted.
+            with self._lock:
+                del self._inflight[key]
+                if pending.entry is not None:
+                    self._store(key, pending.entry)
+            if pending.entry is None and pending.error is None:
+                pending.error = RuntimeError('Ticket fetch was interrupted')
+            pending.done.set()
+        if pending.error is not None:
+            if entry is not None and entry.endtime > self.clock():
+                # Renewal failed but the old ticket is still good.
+                return entry
+            raise pending.error
+        return pending.entry
+
+
+if __name__ == '__main__':
+    import asn1
+
+    def enc_part(authtime, endtime):
+        p = asn1.EncTGSRepPart()
+        p['authtime'] = time.strftime('%Y%m%d%H%M%SZ', time.gmtime(authtime))
+        p['endtime'] = time.strftime('%Y%m%d%H%M%SZ', time.gmtime(endtime))
+        return p
+
+    now = [1000000000]
+    calls = []
+    release = threading.Event()
+
+    def fetch(client, server, enctype):
+        calls.append(server)
+        if server == 'slow':
+            release.wait()
+        if server == 'bad':
+            raise ValueError('TGS failure')
+        return (server, 'key', enc_part(now[0], now[0] + 3600))
+
+    cache = TicketCache(fetch, maxsize=2, renew_margin=60,
+                        clock=lambda: now[0])
+
+    # A hit does not fetch again.
+    e = cache.get('user', 'host/a', 18)
+    assert(cache.get('user', 'host/a', 18) is e)
+    assert(calls == ['host/a'])
+
+    # Entries are refreshed near expiry and dropped after it.
+    now[0] += 3550
+    e2 = cache.get('user', 'host/a', 18)
+    assert(e2 is not e and calls == ['host/a', 'host/a'])
+    now[0] += 3601
+    cache.get('user', 'host/b', 18)
+    assert(len(cache) == 1)
+
+    # The least recently used entry is evicted.
+    cache.get('user', 'host/c', 18)
+    cache.get('user', 'host/b', 18)
+    cache.get('user', 'host/d', 18)
+    assert(len(cache) == 2)
+    del calls[:]
+    cache.get('user', 'host/b', 18)
+    assert(calls == [])
+    cache.get('user', 'host/c', 18)
+    assert(calls == ['host/c'])
+
+    # Concurrent misses share one fetch.
+    del calls[:]
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+                cache.get('user', 'slow', 18))) for i in xrange(8)]
+    for t in threads:
+        t.start()
+    while not calls:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    release.set()
+    for t in threads:
+        t.join()
+    assert(calls == ['slow'] and len(set(map(id, results))) == 1)
+
+    # Fetch errors propagate.
+    try:
+        cache.get('user', 'bad', 18)
+        assert(False)
+    except ValueError:
+        pass
+
+    # An interrupted fetch does not leave later lookups waiting.
+    def interrupted(client, server, enctype):
+        raise KeyboardInterrupt()
+    cache.fetch = interrupted
+    try:
+        cache.get('user', 'host/i', 18)
+        assert(False)
+    except KeyboardInterrupt:
+        pass
+    cache.fetch = fetch
+    del calls[:]
+    cache.get('user', 'host/i', 18)
+    assert(calls == ['host/i'])